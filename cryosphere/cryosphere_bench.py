@@ -0,0 +1,287 @@
+import sys
+import json
+import torch
+import argparse
+import platform
+import itertools
+import numpy as np
+from time import time
+from datetime import datetime
+import multiprocessing as mp
+from cryosphere.model import utils
+from cryosphere.model import renderer
+from cryosphere.model.ctf import CTF
+from cryosphere.model.gmm import EMAN2Grid
+from cryosphere.model.segmentation import Segmentation
+from cryosphere.model.loss import compute_clashing_distances, calc_clash_loss, find_range_cutoff_pairs
+
+
+def random_structure(N_residues, device):
+    """
+    Random chain of residues, with consecutive residues 3.8Å apart as in a protein backbone.
+    :param N_residues: integer, number of residues.
+    :param device: torch device.
+    :return: torch.tensor(N_residues, 3) coordinates of the residues, centered on the origin.
+    """
+    steps = torch.randn((N_residues, 3), device=device)
+    steps = 3.8*steps/torch.linalg.vector_norm(steps, dim=-1, keepdim=True)
+    coordinates = torch.cumsum(steps, dim=0)
+    return coordinates - coordinates.mean(dim=0)
+
+
+def setup_project(N_residues, Npix, batch_size, N_segments, device, backward):
+    grid = EMAN2Grid(Npix, 1.0, device=device)
+    structures = random_structure(N_residues, device)[None].repeat(batch_size, 1, 1).requires_grad_(backward)
+    sigmas = torch.ones((N_residues, 1), device=device)*2
+    amplitudes = torch.ones((N_residues, 1), device=device)
+    return lambda: renderer.project(structures, sigmas, amplitudes, grid)
+
+
+def setup_structure_to_volume(N_residues, Npix, batch_size, N_segments, device, backward):
+    grid = EMAN2Grid(Npix, 1.0, device=device)
+    structures = random_structure(N_residues, device)[None].repeat(batch_size, 1, 1).requires_grad_(backward)
+    sigmas = torch.ones((N_residues, 1), device=device)*2
+    amplitudes = torch.ones((N_residues, 1), device=device)
+    return lambda: renderer.structure_to_volume(structures, sigmas, amplitudes, grid, device)
+
+
+def setup_compute_ctf(N_residues, Npix, batch_size, N_segments, device, backward):
+    ones = np.ones(batch_size)
+    defocus = np.random.uniform(10000, 20000, size=(2, batch_size))
+    ctf = CTF((Npix*ones).astype(int), ones, defocus[0], defocus[1], np.random.uniform(0, 180, batch_size), 300*ones, 2.7*ones, 0.1*ones, device=device)
+    indexes = torch.arange(batch_size, device=device)
+    return lambda: ctf.compute_ctf(indexes)
+
+
+def setup_translate(N_residues, Npix, batch_size, N_segments, device, backward):
+    translator = utils.SpatialGridTranslate(Npix, device=device)
+    images = torch.randn((batch_size, Npix, Npix), device=device)
+    translations = torch.randn((batch_size, 2), device=device)*2
+    return lambda: translator.transform(images, translations[:, None, :])
+
+
+def setup_low_pass_images(N_residues, Npix, batch_size, N_segments, device, backward):
+    lp_mask2d = torch.from_numpy(utils.low_pass_mask2d(Npix, 1.0, 10)).to(device)
+    images = torch.randn((batch_size, Npix, Npix), device=device)
+    return lambda: utils.low_pass_images(images, lp_mask2d)
+
+
+def make_segmenter(N_residues, N_segments, device):
+    segmentation_config = {"part1":{"all_protein":True, "N_segm":N_segments, "segmentation_start":{"type":"uniform"}, "segmentation_prior":{"type":"uniform"}}}
+    return Segmentation(segmentation_config, np.arange(N_residues), np.array(["A"]*N_residues), device=device).to(device)
+
+
+def setup_deform_structure(N_residues, Npix, batch_size, N_segments, device, backward):
+    segmenter = make_segmenter(N_residues, N_segments, device)
+    with torch.no_grad():
+        segmentation = segmenter.sample_segments(batch_size)
+
+    atom_positions = random_structure(N_residues, device)
+    quaternions = {"part1":torch.randn((batch_size, N_segments, 4), device=device).requires_grad_(backward)}
+    translations = {"part1":torch.randn((batch_size, N_segments, 3), device=device).requires_grad_(backward)}
+    def deform():
+        translation_per_residue = utils.compute_translations_per_residue(translations, segmentation, N_residues, batch_size, device)
+        return utils.deform_structure(atom_positions, translation_per_residue, quaternions, segmentation, device)
+
+    return deform
+
+
+def setup_sample_segments(N_residues, Npix, batch_size, N_segments, device, backward):
+    segmenter = make_segmenter(N_residues, N_segments, device)
+    return lambda: segmenter.sample_segments(batch_size)["part1"]["segmentation"]
+
+
+def setup_compute_clashing_distances(N_residues, Npix, batch_size, N_segments, device, backward):
+    structures = random_structure(N_residues, device)[None].repeat(batch_size, 1, 1)
+    structures = (structures + 0.5*torch.randn_like(structures)).requires_grad_(backward)
+    return lambda: compute_clashing_distances(structures, device)
+
+
+def setup_calc_clash_loss(N_residues, Npix, batch_size, N_segments, device, backward):
+    structure = random_structure(N_residues, device)
+    pairs = torch.tensor(find_range_cutoff_pairs(structure.cpu().numpy(), 4, 10), dtype=torch.long, device=device)
+    structures = structure[None].repeat(batch_size, 1, 1)
+    structures = (structures + 0.5*torch.randn_like(structures)).requires_grad_(backward)
+    return lambda: calc_clash_loss(structures, pairs)
+
+
+#For each benchmark: the function creating the function to time, the sizes it depends on, and whether it is differentiable.
+BENCHMARKS = {"project":(setup_project, ["N_residues", "Npix", "batch_size"], True),
+              "structure_to_volume":(setup_structure_to_volume, ["N_residues", "Npix", "batch_size"], True),
+              "compute_ctf":(setup_compute_ctf, ["Npix", "batch_size"], False),
+              "translate":(setup_translate, ["Npix", "batch_size"], False),
+              "low_pass_images":(setup_low_pass_images, ["Npix", "batch_size"], False),
+              "deform_structure":(setup_deform_structure, ["N_residues", "batch_size"], True),
+              "sample_segments":(setup_sample_segments, ["N_residues", "batch_size"], True),
+              "compute_clashing_distances":(setup_compute_clashing_distances, ["N_residues", "batch_size"], True),
+              "calc_clash_loss":(setup_calc_clash_loss, ["N_residues", "batch_size"], True)}
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def run_benchmark(name, sizes, N_segments, device, backward, min_run_time, measure_memory):
+    """
+    Times one configuration of a benchmark.
+    :param name: str, name of the benchmark, key of BENCHMARKS.
+    :param sizes: dictionnary with the number of residues "N_residues", of pixels "Npix" and the batch size "batch_size".
+    :param N_segments: integer, number of segments of the segmentation.
+    :param device: torch device.
+    :param backward: boolean, whether to time the backward pass too.
+    :param min_run_time: float, minimum time in seconds spent running the configuration.
+    :param measure_memory: boolean, whether the peak memory can be measured. On cpu, it requires a new process for each configuration.
+    :return: dictionnary with the configuration, the median and interquartile range of the times in ms and the peak memory in MB.
+    """
+    torch.manual_seed(0)
+    np.random.seed(0)
+    setup, _, differentiable = BENCHMARKS[name]
+    backward = backward and differentiable
+    function = setup(sizes.get("N_residues"), sizes.get("Npix"), sizes.get("batch_size"), N_segments, device, backward)
+    def step():
+        output = function()
+        if backward:
+            output.sum().backward()
+
+    synchronize(device)
+    #The peak memory is measured on top of the memory used before the first run, which includes the inputs.
+    utils.reset_peak_memory(device)
+    start_memory = torch.cuda.memory_allocated(device) / 2**20 if torch.device(device).type == "cuda" else utils.peak_memory(device)
+    step()
+    synchronize(device)
+    times = []
+    start_runs = time()
+    while len(times) < 3 or time() - start_runs < min_run_time:
+        start = time()
+        step()
+        synchronize(device)
+        times.append(time() - start)
+
+    peak_memory = utils.peak_memory(device) - start_memory if measure_memory or torch.device(device).type == "cuda" else None
+    return {"benchmark":name, **sizes, "backward":backward, "runs":len(times), "time_ms":1000*float(np.median(times)),
+            "time_iqr_ms":1000*float(np.subtract(*np.percentile(times, [75, 25]))), "peak_memory_mb":peak_memory}
+
+
+def configurations(benchmarks, sweeps):
+    """
+    Lists the configurations of the benchmarks. Each benchmark only sweeps the sizes it depends on.
+    :param benchmarks: list of str, names of the benchmarks.
+    :param sweeps: dictionnary, for each size, the list of values to sweep.
+    :return: list of (name, sizes) tuples.
+    """
+    configs = []
+    for name in benchmarks:
+        size_names = BENCHMARKS[name][1]
+        for values in itertools.product(*[sweeps[size_name] for size_name in size_names]):
+            configs.append((name, dict(zip(size_names, values))))
+
+    return configs
+
+
+def result_key(result):
+    return (result["benchmark"], result.get("N_residues"), result.get("Npix"), result.get("batch_size"), result["backward"])
+
+
+def compare(results, baseline_results, tolerance):
+    """
+    Compares the results to a baseline.
+    :param results: list of dictionnaries, see run_benchmark.
+    :param baseline_results: list of dictionnaries, results of the baseline.
+    :param tolerance: float, relative increase above which a configuration is flagged as a regression.
+    :return: list of str, description of the regressions.
+    """
+    baseline = {result_key(result): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+
+        time_ratio = result["time_ms"]/base["time_ms"]
+        memory_ratio = None
+        if result["peak_memory_mb"] is not None and base["peak_memory_mb"]:
+            memory_ratio = result["peak_memory_mb"]/base["peak_memory_mb"]
+
+        flags = []
+        if time_ratio > 1 + tolerance:
+            flags.append(f"time {base['time_ms']:.3f}ms -> {result['time_ms']:.3f}ms (x{time_ratio:.2f})")
+
+        if memory_ratio is not None and memory_ratio > 1 + tolerance:
+            flags.append(f"peak memory {base['peak_memory_mb']:.1f}MB -> {result['peak_memory_mb']:.1f}MB (x{memory_ratio:.2f})")
+
+        status = "REGRESSION" if flags else "ok"
+        memory_string = f", memory x{memory_ratio:.2f}" if memory_ratio is not None else ""
+        print(f"{status:>10} {describe(result)}: time x{time_ratio:.2f}{memory_string}")
+        if flags:
+            regressions.append(f"{describe(result)}: " + ", ".join(flags))
+
+    return regressions
+
+
+def describe(result):
+    sizes = ", ".join([f"{size_name}={result[size_name]}" for size_name in ["N_residues", "Npix", "batch_size"] if size_name in result])
+    return f"{result['benchmark']}({sizes}{', backward' if result['backward'] else ''})"
+
+
+def cryosphere_bench():
+    """
+    This function serves as an entry point to be called from the command line
+    """
+    parser_arg = argparse.ArgumentParser(description="Microbenchmarks of the renderer, the ctf, the image translation and filtering, the deformation, the segmentation and the clashing losses.")
+    parser_arg.add_argument("--benchmarks", nargs="+", type=str, default=list(BENCHMARKS.keys()), choices=list(BENCHMARKS.keys()), help="Benchmarks to run. All of them by default.")
+    parser_arg.add_argument("--N_residues", nargs="+", type=int, default=[500, 2000], help="Numbers of residues of the structures to sweep.")
+    parser_arg.add_argument("--Npix", nargs="+", type=int, default=[64, 128], help="Numbers of pixels on each side of the images to sweep.")
+    parser_arg.add_argument("--batch_size", nargs="+", type=int, default=[8, 32], help="Batch sizes to sweep.")
+    parser_arg.add_argument("--N_segments", type=int, default=20, help="Number of segments of the segmentation.")
+    parser_arg.add_argument("--device", type=str, default="cpu", help="Device on which to run the benchmarks, for example cpu or cuda:0.")
+    parser_arg.add_argument("--backward", action=argparse.BooleanOptionalAction, default=False, help="Also time the backward pass of the differentiable benchmarks.")
+    parser_arg.add_argument("--min_run_time", type=float, default=0.5, help="Minimum time in seconds spent running each configuration. At least 3 runs are made after a warm up run.")
+    parser_arg.add_argument("--isolate", action=argparse.BooleanOptionalAction, default=True, help="""Run each configuration in a new process, so that the peak memory of
+                            a configuration is not hidden by the previous ones. Required to measure the memory on cpu.""")
+    parser_arg.add_argument("--output", type=str, required=False, help="Path of the json file in which the results are written.")
+    parser_arg.add_argument("--baseline", type=str, required=False, help="""Path of a json file written by a previous run. The configurations present in both runs are compared
+                            and the command exits with an error if one of them is slower or uses more memory than the baseline by more than the tolerance.""")
+    parser_arg.add_argument("--tolerance", type=float, default=0.1, help="Relative increase of time or memory over the baseline above which a configuration is flagged as a regression.")
+    args = parser_arg.parse_args()
+    sweeps = {"N_residues":args.N_residues, "Npix":args.Npix, "batch_size":args.batch_size}
+    results = []
+    if args.isolate:
+        #A new process is spawned for each configuration, so that the peak resident memory of the process is the one of this configuration.
+        pool = mp.get_context("spawn").Pool(1, maxtasksperchild=1)
+
+    for name, sizes in configurations(args.benchmarks, sweeps):
+        benchmark_args = (name, sizes, args.N_segments, args.device, args.backward, args.min_run_time, args.isolate)
+        if args.isolate:
+            result = pool.apply(run_benchmark, benchmark_args)
+        else:
+            result = run_benchmark(*benchmark_args)
+
+        memory_string = f", peak memory {result['peak_memory_mb']:.1f}MB" if result["peak_memory_mb"] is not None else ""
+        print(f"{describe(result)}: {result['time_ms']:.3f}ms +- {result['time_iqr_ms']:.3f}ms over {result['runs']} runs{memory_string}")
+        results.append(result)
+
+    if args.isolate:
+        pool.close()
+        pool.join()
+
+    run = {"date":datetime.now().isoformat(), "torch_version":torch.__version__, "device":args.device, "num_threads":torch.get_num_threads(),
+           "platform":platform.platform(), "min_run_time":args.min_run_time, "N_segments":args.N_segments, "results":results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(run, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline_run = json.load(file)
+
+        regressions = compare(results, baseline_run["results"], args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}:")
+            print("\n".join(regressions))
+            sys.exit(1)
+
+        print(f"No regression against {args.baseline}.")
+
+
+if __name__ == '__main__':
+    cryosphere_bench()
@@ -1,5 +1,6 @@
 import sys
 import torch
+import signal
 import wandb
 import logging
 import argparse
@@ -13,7 +14,9 @@ from cryosphere.model import renderer
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
-from cryosphere.model.utils import low_pass_images, ddp_setup
+from cryosphere.model.utils import ddp_setup, ImagePreprocessor
+from cryosphere.model.dataset import DevicePrefetcher
+from cryosphere.model.profiling import StageTimer, TraceWindow, forward_signal
 from torch.distributed import destroy_process_group
 from cryosphere.model.loss import compute_loss, find_range_cutoff_pairs, remove_duplicate_pairs, find_continuous_pairs, calc_dist_by_pair_indices
 
@@ -25,62 +28,199 @@ logger = logging.getLogger(__name__)
 parser_arg = argparse.ArgumentParser()
 parser_arg.add_argument('--experiment_yaml', type=str, required=True, help="path to the yaml containing all the parameters for the cryoSPHERE run.")
 
-def train(rank, world_size, yaml_setting_path):
+def train(rank, world_size, yaml_setting_path, ready_ranks=None):
     """
     train a VAE network
     :param yaml_setting_path: str, path the yaml containing all the details of the experiment
+    :param ready_ranks: shared array of world_size bytes, set to 1 by each process once it handles SIGUSR1, see cryosphere_train.
     """
+    if hasattr(signal, "SIGUSR1"):
+        #SIGUSR1 terminates a process by default. It is ignored during the setup, until the trace window installs its handler.
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
     ddp_setup(rank, world_size)
     (vae, image_translator, ctf, grid, gmm_repr, optimizer, dataset, N_epochs, batch_size, experiment_settings, device, scheduler, 
     base_structure, lp_mask2d, mask_images, amortized, path_results, structural_loss_parameters, segmenter) = model.utils.parse_yaml(yaml_setting_path, rank)
     start_training(vae, image_translator, ctf, grid, gmm_repr, optimizer, dataset, N_epochs, batch_size, experiment_settings, scheduler, 
-    base_structure, lp_mask2d, mask_images, amortized, path_results, structural_loss_parameters, segmenter, rank)
+    base_structure, lp_mask2d, mask_images, amortized, path_results, structural_loss_parameters, segmenter, rank, ready_ranks=ready_ranks)
     destroy_process_group()
 
+def deform(gmm_repr, translations_per_domain, quaternions_per_domain, segmentation, N_residues, device):
+    """
+    Deforms the base structure according to the output of the decoder and the segmentation.
+    :param gmm_repr: object of class Gaussian, representation of the base structure.
+    :param translations_per_domain: dictionnary, for each part of the protein torch.tensor(N_batch, N_segments, 3) translations for each segment.
+    :param quaternions_per_domain: dictionnary, for each part of the protein torch.tensor(N_batch, N_segments, 4) quaternions for each segment.
+    :param segmentation: dictionnary, see Segmentation.sample_segments.
+    :param N_residues: integer, number of residues of the protein.
+    :param device: torch device on which we train.
+    :return: torch.tensor(N_batch, N_residues, 3) predicted structures.
+    """
+    batch_size = next(iter(translations_per_domain.values())).shape[0]
+    translation_per_residue = model.utils.compute_translations_per_residue(translations_per_domain, segmentation, N_residues, batch_size, device)
+    return model.utils.deform_structure(gmm_repr.mus, translation_per_residue, quaternions_per_domain, segmentation, device)
+
+
+def render(predicted_structures, poses, indexes, gmm_repr, grid, ctf, f_std, fourier_rendering, autocast_settings, chunk_size, stage_timer):
+    """
+    Poses the predicted structures, projects them and applies the ctf.
+    :param predicted_structures: torch.tensor(N_batch, N_residues, 3) predicted structures.
+    :param poses: torch.tensor(N_batch, 3, 3) rotation matrices of the poses.
+    :param indexes: torch.tensor(N_batch) indexes of the images in the dataset.
+    :param gmm_repr: object of class Gaussian, representation of the base structure.
+    :param grid: object of class EMAN2Grid.
+    :param ctf: object of class CTF.
+    :param f_std: float, standard deviation of the images used to normalize them.
+    :param fourier_rendering: boolean, whether the images are rendered in fourier space.
+    :param autocast_settings: dictionnary, arguments of torch.autocast for the projection in real space.
+    :param chunk_size: integer or None, see renderer.project.
+    :param stage_timer: object of class StageTimer, to instrument the projection and the ctf.
+    :return: torch.tensor(N_batch, N_pix, N_pix) predicted images without ctf, in fourier space if fourier_rendering is True, 
+            and torch.tensor(N_batch, N_pix, N_pix) normalized predicted images with ctf.
+    """
+    if fourier_rendering:
+        with stage_timer.stage("project"):
+            posed_predicted_structures = renderer.rotate_structure(predicted_structures, poses)
+            predicted_images = renderer.project_fourier(posed_predicted_structures, gmm_repr.sigmas, gmm_repr.amplitudes, grid)
+
+        with stage_timer.stage("apply_ctf"):
+            return predicted_images, renderer.apply_ctf_fourier(predicted_images, ctf, indexes)/f_std
+
+    #In mixed precision, the projection runs in reduced precision and the ctf in fp32.
+    with stage_timer.stage("project"):
+        posed_predicted_structures = renderer.rotate_structure(predicted_structures, poses)
+        with torch.autocast(**autocast_settings):
+            predicted_images = renderer.project(posed_predicted_structures, gmm_repr.sigmas, gmm_repr.amplitudes, grid, chunk_size=chunk_size)
+
+    with stage_timer.stage("apply_ctf"):
+        predicted_images = predicted_images.float()
+        return predicted_images, renderer.apply_ctf(predicted_images, ctf, indexes)/f_std
+
+
 def start_training(vae, image_translator, ctf, grid, gmm_repr, optimizer, dataset, N_epochs, batch_size, experiment_settings, scheduler, 
-    base_structure, lp_mask2d, mask_images, amortized, path_results, structural_loss_parameters, segmenter, gpu_id):
+    base_structure, lp_mask2d, mask_images, amortized, path_results, structural_loss_parameters, segmenter, gpu_id, ready_ranks=None):
     vae = DDP(vae, device_ids=[gpu_id])
     segmenter = DDP(segmenter, device_ids=[gpu_id])
+    fourier_rendering = experiment_settings.get("fourier_rendering", False)
+    precision = experiment_settings.get("precision", "fp32")
+    assert precision in model.utils.PRECISIONS, f"precision must be one of {list(model.utils.PRECISIONS.keys())}, not {precision}."
+    device_type = torch.device(gpu_id).type
+    autocast_settings = {"device_type":device_type, "dtype":model.utils.PRECISIONS[precision], "enabled":precision != "fp32"}
+    #Gradients in fp16 may underflow, so the loss is scaled. The scaler does nothing in fp32 and bf16.
+    scaler = torch.amp.GradScaler(device_type, enabled=precision == "fp16")
+    micro_batch_size = experiment_settings.get("micro_batch_size") or batch_size
+    activation_checkpointing = experiment_settings.get("activation_checkpointing", False)
+    metrics_log_every = experiment_settings.get("metrics_log_every")
+    profiling_settings = experiment_settings.get("profiling") or {}
+    #The stages are only timed if the stage timers are enabled. They are recorded as named ranges during the captures of traces.
+    stage_timer = StageTimer(gpu_id, timers=profiling_settings.get("stage_timers", False))
+    #Besides the window set in the yaml, a trace can be captured on demand during the training, by sending SIGUSR1 or touching the trigger file.
+    trace_window = TraceWindow(path_results, gpu_id, start_step=profiling_settings.get("trace_start_step"), N_steps=profiling_settings.get("trace_N_steps", 5), 
+                               rank=torch.distributed.get_rank(), stage_timer=stage_timer, trigger_file=profiling_settings.get("trigger_file", "profile_trigger"))
+    trace_window.install_signal_handler()
+    if ready_ranks is not None:
+        #From now on, the process launching the training forwards SIGUSR1 to this process.
+        ready_ranks[torch.distributed.get_rank()] = 1
+
+    assert micro_batch_size > 0, f"micro_batch_size must be a positive integer, not {micro_batch_size}."
+    image_preprocessor = None
+    if dataset.raw_images:
+        image_preprocessor = ImagePreprocessor(dataset.side_shape, dataset.down_side_shape, dataset.f_std, image_translator, lp_mask2d, 
+                                               rad_mask=dataset.rad_mask, device=gpu_id, fourier=fourier_rendering)
+
+    #The data loader is created once so that its workers are kept alive between epochs.
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers = experiment_settings["num_workers"], drop_last=True, sampler=DistributedSampler(dataset, drop_last=True), 
+                             pin_memory=device_type == "cuda", persistent_workers=experiment_settings["num_workers"] > 0)
+    #The fourier transforms of the images are not used for training, so they are not copied to the gpu.
+    prefetcher = DevicePrefetcher(data_loader, gpu_id, copy_items=[0, 1, 2, 3])
     for epoch in range(N_epochs):
-        tracking_metrics = {"wandb":experiment_settings["wandb"], "epoch": epoch, "path_results":path_results ,"correlation_loss":[], "kl_prior_latent":[], 
-                            "kl_prior_segmentation_mean":[], "kl_prior_segmentation_std":[], "kl_prior_segmentation_proportions":[], "l2_pen":[], "continuity_loss":[], 
-                            "clashing_loss":[]}
+        metrics = model.utils.MetricsAccumulator(["correlation_loss", "kl_prior_latent", "kl_prior_segmentation_mean", "kl_prior_segmentation_std", 
+                                                  "kl_prior_segmentation_proportions", "l2_pen", "continuity_loss", "clashing_loss"], gpu_id)
+        tracking_metrics = {"wandb":experiment_settings["wandb"], "epoch": epoch, "path_results":path_results, "metrics":metrics}
 
-        data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers = experiment_settings["num_workers"], drop_last=True, sampler=DistributedSampler(dataset, drop_last=True))
         start_tot = time()
         data_loader.sampler.set_epoch(epoch) 
-        data_loader = tqdm(iter(data_loader))
-        for batch_num, (indexes, batch_images, batch_poses, batch_poses_translation, _) in enumerate(data_loader):
-            batch_images = batch_images.to(gpu_id)
-            batch_poses = batch_poses.to(gpu_id)
-            batch_poses_translation = batch_poses_translation.to(gpu_id)
-            indexes = indexes.to(gpu_id)
-            flattened_batch_images = batch_images.flatten(start_dim=-2)
-            batch_translated_images = image_translator.transform(batch_images, batch_poses_translation[:, None, :])
-            lp_batch_translated_images = low_pass_images(batch_translated_images, lp_mask2d)
-            if amortized:
-                latent_variables, latent_mean, latent_std = vae.module.sample_latent(flattened_batch_images)
-            else:
-                latent_variables, latent_mean, latent_std = vae.module.sample_latent(None, indexes)
-
-            segmentation = segmenter.module.sample_segments(batch_images.shape[0])
-            quaternions_per_domain, translations_per_domain = vae.module.decode(latent_variables)
-            translation_per_residue = model.utils.compute_translations_per_residue(translations_per_domain, segmentation, base_structure.coord.shape[0], batch_size, gpu_id)
-            predicted_structures = model.utils.deform_structure(gmm_repr.mus, translation_per_residue, quaternions_per_domain, segmentation, gpu_id)
-            posed_predicted_structures = renderer.rotate_structure(predicted_structures, batch_poses)
-            predicted_images  = renderer.project(posed_predicted_structures, gmm_repr.sigmas, gmm_repr.amplitudes, grid)
-            batch_predicted_images = renderer.apply_ctf(predicted_images, ctf, indexes)/dataset.f_std
-            loss = compute_loss(batch_predicted_images, lp_batch_translated_images, None, latent_mean, latent_std, vae.module, segmenter.module, experiment_settings, tracking_metrics, 
-                structural_loss_parameters= structural_loss_parameters, epoch=epoch, predicted_structures=predicted_structures, device=gpu_id)
-
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
-
+        model.utils.reset_peak_memory(gpu_id)
+        start_steps = time()
+        for batch_num, (indexes, batch_images, batch_poses, batch_poses_translation, _) in enumerate(tqdm(prefetcher)):
+            with stage_timer.stage("translation_low_pass"):
+                if image_preprocessor is not None:
+                    batch_images, lp_batch_translated_images = image_preprocessor(batch_images, batch_poses_translation)
+                elif fourier_rendering:
+                    lp_batch_translated_images = image_translator.fourier_transform_low_pass(batch_images, batch_poses_translation, lp_mask2d)
+                else:
+                    lp_batch_translated_images = image_translator.transform_low_pass(batch_images, batch_poses_translation, lp_mask2d)
+
+            #The batch is split into micro-batches whose gradients are accumulated before a single optimizer step, to bound the memory used by
+            #the projection. The loss of each micro-batch is weighted by its share of the batch, so the gradient is the one of the full batch.
+            micro_batches = list(zip(indexes.split(micro_batch_size), batch_images.split(micro_batch_size), batch_poses.split(micro_batch_size), 
+                                lp_batch_translated_images.split(micro_batch_size)))
+            for micro_indexes, micro_images, micro_poses, micro_lp_translated_images in micro_batches:
+                flattened_batch_images = micro_images.flatten(start_dim=-2)
+                #In mixed precision, only the encoder, the decoder and the projection run in reduced precision. The deformation, the ctf and the losses stay in fp32.
+                with torch.autocast(**autocast_settings):
+                    with stage_timer.stage("encoder"):
+                        if amortized:
+                            latent_variables, latent_mean, latent_std = vae.module.sample_latent(flattened_batch_images)
+                        else:
+                            latent_variables, latent_mean, latent_std = vae.module.sample_latent(None, micro_indexes)
+
+                    with stage_timer.stage("decoder"):
+                        quaternions_per_domain, translations_per_domain = vae.module.decode(latent_variables)
+
+                latent_variables, latent_mean, latent_std = latent_variables.float(), latent_mean.float(), latent_std.float()
+                quaternions_per_domain = {part: quaternions.float() for part, quaternions in quaternions_per_domain.items()}
+                translations_per_domain = {part: translations.float() for part, translations in translations_per_domain.items()}
+                with stage_timer.stage("sample_segments"):
+                    segmentation = segmenter.module.sample_segments(micro_images.shape[0])
+
+                #With activation checkpointing, the intermediate tensors of the deformation and of the rendering are recomputed during the backward pass
+                #instead of being stored. Only the predicted structures and images are kept.
+                with stage_timer.stage("deform"):
+                    predicted_structures = model.utils.checkpoint_segment(deform, gmm_repr, translations_per_domain, quaternions_per_domain, segmentation, 
+                                                                          base_structure.coord.shape[0], gpu_id, enabled=activation_checkpointing)
+
+                predicted_images, batch_predicted_images = model.utils.checkpoint_segment(render, predicted_structures, micro_poses, micro_indexes, gmm_repr, grid, ctf, 
+                                                                      dataset.f_std, fourier_rendering, autocast_settings, experiment_settings.get("projection_chunk_size"), 
+                                                                      stage_timer, enabled=activation_checkpointing)
+
+                with stage_timer.stage("loss"):
+                    loss = compute_loss(batch_predicted_images, micro_lp_translated_images, None, latent_mean, latent_std, vae.module, segmenter.module, experiment_settings, 
+                        tracking_metrics, structural_loss_parameters= structural_loss_parameters, epoch=epoch, predicted_structures=predicted_structures, device=gpu_id, 
+                        fourier=fourier_rendering)
+
+                with stage_timer.stage("backward"):
+                    scaler.scale(loss*micro_images.shape[0]/batch_images.shape[0]).backward()
+
+            #The forward passes call the methods of vae.module and segmenter.module instead of the DDP wrappers, so DDP does not synchronize the
+            #gradients during the backward passes. They are averaged over the GPUs once per batch, after the last micro-batch.
+            with stage_timer.stage("all_reduce"):
+                model.utils.all_reduce_gradients(list(vae.parameters()) + list(segmenter.parameters()))
+
+            with stage_timer.stage("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+
+            trace_window.step(data_wait=prefetcher.last_wait)
+            if metrics_log_every and (batch_num + 1) % metrics_log_every == 0:
+                #Synchronizes all the processes, see MetricsAccumulator.reduce.
+                running_means = metrics.reduce()
+                if gpu_id == 0:
+                    logging.info(f"Epoch {epoch}, step {batch_num + 1}: " + " || ".join([f"{name}: {value}" for name, value in running_means.items()]))
+
+        model.utils.log_step_statistics(epoch, batch_num + 1, time() - start_steps, precision, gpu_id, data_wait=sum(prefetcher.wait_times))
+        stage_timer.add("data_wait", sum(prefetcher.wait_times))
+        stage_timer.log(epoch, batch_num + 1)
         if scheduler:
             scheduler.step()
 
-        model.utils.monitor_training(segmentation, segmenter.module, tracking_metrics, experiment_settings, vae.module, optimizer, predicted_images, batch_images, gpu_id)
+        if fourier_rendering:
+            predicted_images = renderer.fourier2d_to_primal(predicted_images)
+
+        model.utils.monitor_training(segmentation, segmenter.module, tracking_metrics, experiment_settings, vae.module, optimizer, predicted_images, micro_images, gpu_id)
+
+    trace_window.close()
 
 
 def cryosphere_train():
@@ -91,7 +231,15 @@ def cryosphere_train():
     path = args.experiment_yaml
 
     world_size = torch.cuda.device_count()
-    mp.spawn(train, args=(world_size, path), nprocs=world_size)
+    #Each training process sets its byte once it handles SIGUSR1, so that the signal is not forwarded to the processes still setting up.
+    ready_ranks = mp.get_context("spawn").RawArray("b", world_size)
+    context = mp.spawn(train, args=(world_size, path, ready_ranks), nprocs=world_size, join=False)
+    if hasattr(signal, "SIGUSR1"):
+        #Sending SIGUSR1 to this process captures a trace of the next steps in every training process, see profiling.TraceWindow.
+        forward_signal(signal.SIGUSR1, [process.pid for process in context.processes], ready=ready_ranks)
+
+    while not context.join():
+        pass
 
 
 if __name__ == '__main__':
@@ -0,0 +1,257 @@
+import os
+import yaml
+import torch
+import mrcfile
+import argparse
+import starfile
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import multiprocessing as mp
+from roma import euler_to_rotmat, rotmat_to_rotvec
+from cryosphere.model import renderer
+from cryosphere.model.ctf import CTF
+from cryosphere.model.polymer import Polymer
+from cryosphere.model.gmm import Gaussian, EMAN2Grid
+from cryosphere.model.utils import SpatialGridTranslate
+
+
+#State of each worker of the pool, set once by init_worker so that the structure is not sent with every stack.
+worker_state = {}
+
+
+def init_worker(image_settings, structure_path, simulation_settings, device, num_threads):
+    """
+    Loads the structure and creates the grid and the image translator of a worker.
+    :param image_settings: dictionnary, content of the images yaml file.
+    :param structure_path: str, path to the pdb file of the structure.
+    :param simulation_settings: dictionnary, parameters of the simulation, see simulate.
+    :param device: str, torch device on which the images are rendered.
+    :param num_threads: integer, number of threads used by torch in this worker.
+    """
+    torch.set_num_threads(num_threads)
+    base_structure = Polymer.from_pdb(structure_path, True)
+    Npix = image_settings["Npix"]
+    worker_state["gmm_repr"] = Gaussian(torch.tensor(base_structure.coord, dtype=torch.float32, device=device),
+            torch.ones((base_structure.coord.shape[0], 1), dtype=torch.float32, device=device)*image_settings["sigma_gmm"],
+            torch.tensor(base_structure.num_electron, dtype=torch.float32, device=device)[:, None])
+    worker_state["grid"] = EMAN2Grid(Npix, image_settings["apix"], device=device)
+    worker_state["image_translator"] = SpatialGridTranslate(Npix, device=device)
+    worker_state["image_settings"] = image_settings
+    worker_state["simulation_settings"] = simulation_settings
+    worker_state["device"] = device
+
+
+def sample_parameters(N_images, simulation_settings, rng):
+    """
+    Samples uniformly distributed poses, gaussian translations and the ctf parameters of the images.
+    :param N_images: integer, number of images.
+    :param simulation_settings: dictionnary, parameters of the simulation, see simulate.
+    :param rng: np.random.Generator.
+    :return: dictionnary of np.array(N_images) of the parameters, in the RELION conventions: euler angles and defocus angle in degrees,
+            translations and defocus in Å.
+    """
+    defocusU = rng.uniform(simulation_settings["defocus_min"], simulation_settings["defocus_max"], N_images)
+    return {"rlnAngleRot": rng.uniform(0, 360, N_images),
+            #The cosine of the tilt is uniform so that the poses are uniform over the rotations.
+            "rlnAngleTilt": np.degrees(np.arccos(rng.uniform(-1, 1, N_images))),
+            "rlnAnglePsi": rng.uniform(0, 360, N_images),
+            "rlnOriginXAngst": rng.normal(0, simulation_settings["translation_std"], N_images),
+            "rlnOriginYAngst": rng.normal(0, simulation_settings["translation_std"], N_images),
+            "rlnDefocusU": defocusU,
+            "rlnDefocusV": defocusU - rng.uniform(0, simulation_settings["astigmatism"], N_images),
+            "rlnDefocusAngle": rng.uniform(0, 180, N_images)}
+
+
+def poses_from_angles(parameters):
+    """
+    Computes the rotation matrices of the poses the way dataset.starfile_reader does.
+    :param parameters: dictionnary of the parameters of the images, see sample_parameters.
+    :return: torch.tensor(N_images, 3, 3) of rotation matrices.
+    """
+    euler_angles = np.stack([parameters["rlnAngleRot"], parameters["rlnAngleTilt"], parameters["rlnAnglePsi"]], axis=-1)*np.pi/180
+    return torch.transpose(euler_to_rotmat(convention="ZYZ", angles=torch.tensor(euler_angles, dtype=torch.float32)), dim0=-2, dim1=-1)
+
+
+def render_images(parameters, device):
+    """
+    Renders the images of a batch: poses the structure, projects it, translates the projections, applies the ctf and adds white noise.
+    :param parameters: dictionnary of the parameters of the images, see sample_parameters.
+    :param device: str, torch device.
+    :return: np.array(N_images, Npix, Npix) of float32 images.
+    """
+    gmm_repr = worker_state["gmm_repr"]
+    image_settings = worker_state["image_settings"]
+    simulation_settings = worker_state["simulation_settings"]
+    N_images = len(parameters["rlnDefocusU"])
+    apix = image_settings["apix"]
+    ones = np.ones(N_images)
+    ctf = CTF(image_settings["Npix"]*ones, apix*ones, parameters["rlnDefocusU"], parameters["rlnDefocusV"], parameters["rlnDefocusAngle"],
+              simulation_settings["voltage"]*ones, simulation_settings["spherical_aberration"]*ones, simulation_settings["amplitude_contrast"]*ones,
+              device=device)
+    poses = poses_from_angles(parameters).to(device)
+    #The images are translated by minus the translations of the poses in pixels, in YX mode, so that the training recenters them.
+    translations = torch.tensor(np.stack([parameters["rlnOriginYAngst"], parameters["rlnOriginXAngst"]], axis=-1)/apix, dtype=torch.float32, device=device)
+    with torch.no_grad():
+        posed_structures = renderer.rotate_structure(gmm_repr.mus[None].expand(N_images, -1, -1), poses)
+        images = renderer.project(posed_structures, gmm_repr.sigmas, gmm_repr.amplitudes, worker_state["grid"])
+        images = worker_state["image_translator"].transform(images, -translations[:, None, :])
+        images = renderer.apply_ctf(images, ctf, torch.arange(N_images, device=device))
+        #The standard deviation of the noise is set per image from the variance of the signal and the signal to noise ratio.
+        noise_std = torch.std(images, dim=(-2, -1), keepdim=True)/np.sqrt(simulation_settings["snr"])
+        images = images + noise_std*torch.randn(images.shape, device=device)
+
+    return images.cpu().numpy().astype(np.float32)
+
+
+def simulate_stack(stack_task):
+    """
+    Simulates the images of one mrcs stack. The images are rendered by batches and written to a memory mapped file, so that a stack never
+    has to fit in memory.
+    :param stack_task: tuple (stack_index, N_images, stack_path, seed).
+    :return: dictionnary of np.array(N_images) of the parameters of the images of the stack, see sample_parameters.
+    """
+    stack_index, N_images, stack_path, seed = stack_task
+    image_settings = worker_state["image_settings"]
+    simulation_settings = worker_state["simulation_settings"]
+    #Each stack has its own random generator, so that a dataset does not depend on the number of workers.
+    rng = np.random.default_rng([seed, stack_index])
+    torch.manual_seed(int(rng.integers(2**31)))
+    parameters = sample_parameters(N_images, simulation_settings, rng)
+    Npix = image_settings["Npix"]
+    batch_size = simulation_settings["batch_size"]
+    with mrcfile.new_mmap(stack_path, shape=(N_images, Npix, Npix), mrc_mode=2, overwrite=True) as mrc:
+        mrc.voxel_size = image_settings["apix"]
+        for start in range(0, N_images, batch_size):
+            batch_parameters = {key: val[start:start+batch_size] for key, val in parameters.items()}
+            mrc.data[start:start+batch_size] = render_images(batch_parameters, worker_state["device"])
+
+    parameters["stack_index"] = np.full(N_images, stack_index)
+    parameters["blob_idx"] = np.arange(N_images)
+    return parameters
+
+
+def write_starfile(path, parameters, stack_names, image_settings, simulation_settings):
+    """
+    Writes the poses and the ctf of the images in a RELION star file, readable by dataset.ImageDataSet and CTF.create_ctf.
+    :param path: str, path of the star file.
+    :param parameters: dictionnary of np.array(N_particles) of the parameters of the images.
+    :param stack_names: list of str, paths of the mrcs stacks, relative to the folder of the star file.
+    :param image_settings: dictionnary, content of the images yaml file.
+    :param simulation_settings: dictionnary, parameters of the simulation, see simulate.
+    """
+    optics = pd.DataFrame({"rlnOpticsGroup": [1], "rlnImageSize": [image_settings["Npix"]], "rlnImagePixelSize": [image_settings["apix"]],
+                           "rlnVoltage": [simulation_settings["voltage"]], "rlnSphericalAberration": [simulation_settings["spherical_aberration"]],
+                           "rlnAmplitudeContrast": [simulation_settings["amplitude_contrast"]]})
+    N_particles = len(parameters["blob_idx"])
+    stack_names = np.array(stack_names)
+    particles = pd.DataFrame({"rlnImageName": np.char.add(np.char.add(np.char.zfill((parameters["blob_idx"] + 1).astype(str), 6), "@"),
+                                                          stack_names[parameters["stack_index"]]),
+                              **{key: val for key, val in parameters.items() if key.startswith("rln")},
+                              "rlnPhaseShift": np.zeros(N_particles), "rlnOpticsGroup": np.ones(N_particles, dtype=int)})
+    starfile.write({"optics": optics, "particles": particles}, path, overwrite=True)
+
+
+def write_cs_file(path, parameters, stack_names, image_settings, simulation_settings):
+    """
+    Writes the poses and the ctf of the images in a cryoSPARC cs file, readable by dataset.ImageDataSet and CTF.create_ctf.
+    :param path: str, path of the cs file.
+    :param parameters: dictionnary of np.array(N_particles) of the parameters of the images.
+    :param stack_names: list of str, paths of the mrcs stacks, relative to the folder of the cs file.
+    :param image_settings: dictionnary, content of the images yaml file.
+    :param simulation_settings: dictionnary, parameters of the simulation, see simulate.
+    """
+    N_particles = len(parameters["blob_idx"])
+    path_length = max(len(name) for name in stack_names) + 1
+    cs_dtype = np.dtype([("blob/path", f"S{path_length}"), ("blob/idx", "<u4"), ("blob/shape", "<u4", (2,)), ("blob/psize_A", "<f4"),
+                         ("alignments3D/pose", "<f4", (3,)), ("alignments3D/shift", "<f4", (2,)), ("ctf/df1_A", "<f4"), ("ctf/df2_A", "<f4"),
+                         ("ctf/df_angle_rad", "<f4"), ("ctf/accel_kv", "<f4"), ("ctf/cs_mm", "<f4"), ("ctf/amp_contrast", "<f4"), ("ctf/phase_shift_rad", "<f4")])
+    metadata = np.zeros(N_particles, dtype=cs_dtype)
+    metadata["blob/path"] = np.array([(">" + name).encode("ascii") for name in stack_names])[parameters["stack_index"]]
+    metadata["blob/idx"] = parameters["blob_idx"]
+    metadata["blob/shape"] = image_settings["Npix"]
+    metadata["blob/psize_A"] = image_settings["apix"]
+    #dataset.cs_file_reader transposes the rotation matrix of the rotation vector, as starfile_reader does with the euler angles.
+    metadata["alignments3D/pose"] = rotmat_to_rotvec(torch.transpose(poses_from_angles(parameters), dim0=-2, dim1=-1)).numpy()
+    #The shifts of cs files are in pixels and in XY mode.
+    metadata["alignments3D/shift"] = np.stack([parameters["rlnOriginXAngst"], parameters["rlnOriginYAngst"]], axis=-1)/image_settings["apix"]
+    metadata["ctf/df1_A"] = parameters["rlnDefocusU"]
+    metadata["ctf/df2_A"] = parameters["rlnDefocusV"]
+    metadata["ctf/df_angle_rad"] = parameters["rlnDefocusAngle"]*np.pi/180
+    metadata["ctf/accel_kv"] = simulation_settings["voltage"]
+    metadata["ctf/cs_mm"] = simulation_settings["spherical_aberration"]
+    metadata["ctf/amp_contrast"] = simulation_settings["amplitude_contrast"]
+    with open(path, "wb") as file:
+        np.save(file, metadata)
+
+
+def simulate(image_yaml, structure_path, output_folder, N_particles, simulation_settings, stack_size=10000, num_workers=1, device="cpu", seed=0):
+    """
+    Simulates a dataset of particles from a structure: mrcs stacks of images and the matching star and cs files.
+    :param image_yaml: str, path to the yaml file containing the images informations.
+    :param structure_path: str, path to the pdb file of the structure.
+    :param output_folder: str, folder in which the particles.star and particles.cs files and the stacks folder are written.
+    :param N_particles: integer, number of images.
+    :param simulation_settings: dictionnary with the signal to noise ratio "snr", the standard deviation of the translations in Å "translation_std",
+                            the range of defocus in Å "defocus_min" and "defocus_max", the maximum difference between defocus U and V in Å "astigmatism",
+                            the voltage in keV "voltage", the spherical aberration in mm "spherical_aberration", the amplitude contrast
+                            "amplitude_contrast" and the number of images rendered at once "batch_size".
+    :param stack_size: integer, number of images per mrcs stack. Each stack is simulated by one worker.
+    :param num_workers: integer, number of processes simulating the stacks. If 0, the stacks are simulated in this process.
+    :param device: str, torch device on which the images are rendered.
+    :param seed: integer, seed of the simulation.
+    """
+    with open(image_yaml, "r") as file:
+        image_settings = yaml.safe_load(file)
+
+    os.makedirs(os.path.join(output_folder, "stacks"), exist_ok=True)
+    N_stacks = (N_particles + stack_size - 1)//stack_size
+    stack_names = [os.path.join("stacks", f"particles_{stack_index:06d}.mrcs") for stack_index in range(N_stacks)]
+    stack_tasks = [(stack_index, min(stack_size, N_particles - stack_index*stack_size), os.path.join(output_folder, stack_names[stack_index]), seed)
+                    for stack_index in range(N_stacks)]
+    num_threads = max(1, torch.get_num_threads()//max(num_workers, 1))
+    worker_args = (image_settings, structure_path, simulation_settings, device, num_threads)
+    if num_workers == 0:
+        init_worker(*worker_args)
+        all_parameters = [simulate_stack(stack_task) for stack_task in tqdm(stack_tasks)]
+    else:
+        with mp.get_context("spawn").Pool(num_workers, initializer=init_worker, initargs=worker_args) as pool:
+            all_parameters = list(tqdm(pool.imap(simulate_stack, stack_tasks), total=N_stacks))
+
+    parameters = {key: np.concatenate([stack_parameters[key] for stack_parameters in all_parameters]) for key in all_parameters[0]}
+    write_starfile(os.path.join(output_folder, "particles.star"), parameters, stack_names, image_settings, simulation_settings)
+    write_cs_file(os.path.join(output_folder, "particles.cs"), parameters, stack_names, image_settings, simulation_settings)
+
+
+def run_simulate():
+    """
+    This function serves as an entry point to be called from the command line
+    """
+    parser_arg = argparse.ArgumentParser(description="Simulates a dataset of particles from a structure, to benchmark the data loading and the training.")
+    parser_arg.add_argument('--image_yaml', type=str, required=True, help="path to the yaml containing the images informations.")
+    parser_arg.add_argument("--structure_path", type=str, required=True, help="path to the pdb file of the structure to image.")
+    parser_arg.add_argument("--output_folder", type=str, required=True, help="path to the folder in which the stacks, the star file and the cs file are written.")
+    parser_arg.add_argument("--N_particles", type=int, required=True, help="number of particles to simulate.")
+    parser_arg.add_argument("--stack_size", type=int, default=10000, help="number of particles per mrcs stack.")
+    parser_arg.add_argument("--batch_size", type=int, default=256, help="number of particles rendered at once by each worker.")
+    parser_arg.add_argument("--num_workers", type=int, default=os.cpu_count(), help="number of processes simulating the stacks. If 0, no process is created.")
+    parser_arg.add_argument("--snr", type=float, default=0.1, help="signal to noise ratio of the images.")
+    parser_arg.add_argument("--translation_std", type=float, default=2.0, help="standard deviation of the translations of the particles in Å.")
+    parser_arg.add_argument("--defocus_min", type=float, default=10000, help="minimum defocus in Å.")
+    parser_arg.add_argument("--defocus_max", type=float, default=25000, help="maximum defocus in Å.")
+    parser_arg.add_argument("--astigmatism", type=float, default=500, help="maximum difference between defocus U and defocus V in Å.")
+    parser_arg.add_argument("--voltage", type=float, default=300, help="accelerating voltage in keV.")
+    parser_arg.add_argument("--spherical_aberration", type=float, default=2.7, help="spherical aberration in mm.")
+    parser_arg.add_argument("--amplitude_contrast", type=float, default=0.1, help="amplitude contrast ratio.")
+    parser_arg.add_argument("--device", type=str, default="cpu", help="device on which the images are rendered.")
+    parser_arg.add_argument("--seed", type=int, default=0, help="seed of the simulation.")
+    args = parser_arg.parse_args()
+    simulation_settings = {"snr": args.snr, "translation_std": args.translation_std, "defocus_min": args.defocus_min, "defocus_max": args.defocus_max,
+                           "astigmatism": args.astigmatism, "voltage": args.voltage, "spherical_aberration": args.spherical_aberration,
+                           "amplitude_contrast": args.amplitude_contrast, "batch_size": args.batch_size}
+    simulate(args.image_yaml, args.structure_path, args.output_folder, args.N_particles, simulation_settings, stack_size=args.stack_size,
+             num_workers=args.num_workers, device=args.device, seed=args.seed)
+
+
+if __name__ == '__main__':
+    run_simulate()
@@ -2,6 +2,8 @@ import torch
 import starfile
 import numpy as np
 import matplotlib.pyplot as plt
+from collections import OrderedDict
+from cryosphere.model.fourier import half_frequencies
 
 
 class CTF(torch.nn.Module):
@@ -9,7 +11,7 @@ class CTF(torch.nn.Module):
 	Class describing the ctf, built from starfile
 	"""
 	def __init__(self, side_shape, apix, defocusU, defocusV, defocusAngle, voltage, sphericalAberration, amplitudeContrastRatio, phaseShift=None ,scalefactor = None,
-		bfactor= None, device="cpu"):
+		bfactor= None, device="cpu", cache_size=0):
 		"""
 		side shape: number of pixels on a side.
 		apix: size of a pixel in Å.
@@ -23,6 +25,7 @@ class CTF(torch.nn.Module):
 		scalefactor: scalefactor.
 		bfactor: bfactor.
 		device: str, device to use.
+		cache_size: integer, number of distinct 2D ctf kept in memory, see compute_ctf. If 0, the ctf is computed for each particle at every call.
 		"""
 		super().__init__()
 		if phaseShift is None:
@@ -41,7 +44,7 @@ class CTF(torch.nn.Module):
 			bfactor = torch.tensor(bfactor, dtype=torch.float32, device=device)
 
 
-		saved_args = locals()
+		saved_args = {arg_name: val for arg_name, val in locals().items() if arg_name != "cache_size"}
 		assert len(set({len(val) for arg_name,val in saved_args.items() if arg_name not in ["self", "__class__", "device"]})) == 1, "CTF values do not have the same shape."
 		assert len(set(side_shape)) == 1, "All images must have the same number of pixels"
 		assert len(set(apix)) == 1, "All images must have the same apix"
@@ -66,6 +69,57 @@ class CTF(torch.nn.Module):
 		self.register_buffer("freqs", freqs)
 		self.freqs = self.freqs.to(device)
 
+		#The ctf only depends on the frequencies through s2, s2*cos(2*ang), s2*sin(2*ang) and s2**2, so gamma is a linear combination of this basis.
+		x = freqs[:, 0].double()
+		y = freqs[:, 1].double()
+		ang = torch.arctan2(y, x)
+		s2 = x ** 2 + y ** 2
+		basis = torch.stack([s2, s2 * torch.cos(2 * ang), s2 * torch.sin(2 * ang), s2 ** 2], dim=0)
+		self.register_buffer("s2", s2.float().to(device), persistent=False)
+		self.register_buffer("gamma_basis", basis.float().to(device), persistent=False)
+		#Same basis on the half plane of fourier.primal_to_half_fourier2d, where the rows are y frequencies and the columns x frequencies.
+		half_y, half_x = half_frequencies(self.npix, self.apix)
+		y, x = torch.meshgrid(half_y.double(), half_x.double(), indexing="ij")
+		x = x.flatten()
+		y = y.flatten()
+		ang = torch.arctan2(y, x)
+		s2 = x ** 2 + y ** 2
+		half_basis = torch.stack([s2, s2 * torch.cos(2 * ang), s2 * torch.sin(2 * ang), s2 ** 2], dim=0)
+		self.register_buffer("half_s2", s2.float().to(device), persistent=False)
+		self.register_buffer("half_gamma_basis", half_basis.float().to(device), persistent=False)
+		self.fold_parameters()
+		self.cache_size = cache_size
+		self.cache = OrderedDict()
+		if cache_size > 0:
+			#Particles with the same ctf parameters, typically from the same micrograph, share the same group and the same cached ctf.
+			folded_parameters = torch.cat([self.gamma_coefficients, self.phase_shift_rad, self.sin_amplitude, self.cos_amplitude, self.bfactor], dim=1)
+			_, groups = np.unique(folded_parameters.detach().cpu().numpy(), axis=0, return_inverse=True)
+			self.register_buffer("ctf_groups", torch.from_numpy(groups.reshape(-1)).to(device), persistent=False)
+
+	def fold_parameters(self):
+		"""
+		Folds the per particle parameters into the coefficients of gamma in the basis of gamma_basis and into the amplitudes of its sine and cosine, once for all.
+		"""
+		volt = self.volt.double() * 1000
+		cs = self.cs.double() * 10 ** 7
+		dfu = self.dfU.double()
+		dfv = self.dfV.double()
+		dfang = self.dfang.double() * np.pi / 180
+		w = self.w.double()
+		scalefactor = self.scalefactor.double()
+		# lam = sqrt(h^2/(2*m*e*Vr)); Vr = V + (e/(2*m*c^2))*V^2
+		lam = 12.2639 / torch.sqrt(volt + 0.97845e-6 * volt ** 2)
+		#gamma = 2*pi*(-0.5*df*lam*s2 + 0.25*cs*lam**3*s2**2) - phase_shift, with df = 0.5*(dfu + dfv + (dfu - dfv)*cos(2*(ang - dfang)))
+		coefficients = torch.cat([
+			-0.5 * torch.pi * lam * (dfu + dfv),
+			-0.5 * torch.pi * lam * (dfu - dfv) * torch.cos(2 * dfang),
+			-0.5 * torch.pi * lam * (dfu - dfv) * torch.sin(2 * dfang),
+			0.5 * torch.pi * cs * lam ** 3], dim=1)
+		self.register_buffer("gamma_coefficients", coefficients.float(), persistent=False)
+		self.register_buffer("phase_shift_rad", (self.phaseShift.double() * np.pi / 180).float(), persistent=False)
+		self.register_buffer("sin_amplitude", (torch.sqrt(1 - w ** 2) * scalefactor).float(), persistent=False)
+		self.register_buffer("cos_amplitude", (w * scalefactor).float(), persistent=False)
+
 
 	@classmethod
 	def from_starfile(cls, file, device="cpu", **kwargs):
@@ -122,7 +176,7 @@ class CTF(torch.nn.Module):
 			else:
 				ctf_params[:, i + 2] = df[header].values if header in df else None
 
-		return cls(*ctf_params[:, :8].T, phaseShift=ctf_params[:, 8], device=device)
+		return cls(*ctf_params[:, :8].T, phaseShift=ctf_params[:, 8], device=device, cache_size=kwargs.get("cache_size", 0))
 
 	@classmethod
 	def from_cs_file(cls, cs_file,  device="cpu", **kwargs):
@@ -162,7 +216,7 @@ class CTF(torch.nn.Module):
 			if f in ("ctf/df_angle_rad", "ctf/phase_shift_rad"):  # convert to degrees
 				ctf_params[:, i + 2] *= 180 / np.pi
 
-		return cls(*ctf_params[:, :8].T, phaseShift=ctf_params[:, 8], device=device)
+		return cls(*ctf_params[:, :8].T, phaseShift=ctf_params[:, 8], device=device, cache_size=kwargs.get("cache_size", 0))
 
 	@classmethod
 	def create_ctf(cls, cs_star_config, device="cpu", **kwargs):
@@ -174,11 +228,11 @@ class CTF(torch.nn.Module):
 		file = cs_star_config["file"]
 		assert file.endswith(".cs") or file.endswith(".star"), "The file for CTF must be a starfile or a cryosparc file."
 		if file.endswith(".cs"):
-			return cls.from_cs_file(file, device=device, apix = kwargs["apix"], side_shape = kwargs["side_shape"])
+			return cls.from_cs_file(file, device=device, apix = kwargs["apix"], side_shape = kwargs["side_shape"], cache_size=kwargs.get("cache_size", 0))
 
-		return cls.from_starfile(file, device=device, apix = kwargs["apix"], side_shape = kwargs["side_shape"])
+		return cls.from_starfile(file, device=device, apix = kwargs["apix"], side_shape = kwargs["side_shape"], cache_size=kwargs.get("cache_size", 0))
 
-	def compute_ctf(self, indexes
+	def compute_ctf(self, indexes, half=False
 		) -> torch.Tensor:
 		"""
 		Compute the 2D CTF
@@ -186,49 +240,55 @@ class CTF(torch.nn.Module):
 
 		Input:
 		    indexes: torch.tensor(batch_size) of indexes of the images in this batch.
+		    half: bool, if True the ctf is computed on the half plane of fourier.primal_to_half_fourier2d instead of the centered full plane.
 		"""
-		# convert units
-		volt = self.volt[indexes]
-		cs = self.cs[indexes]
-		dfu = self.dfU[indexes]
-		dfv = self.dfV[indexes]
-		dfang = self.dfang[indexes]
-		w = self.w[indexes]
-		phase_shift = self.phaseShift[indexes]
-		bfactor = self.bfactor[indexes]
-		scalefactor = self.scalefactor[indexes]
-
-		volt = volt * 1000
-		cs = cs * 10 ** 7
-		dfang = dfang * np.pi / 180
-		phase_shift = phase_shift * np.pi / 180
-
-		# lam = sqrt(h^2/(2*m*e*Vr)); Vr = V + (e/(2*m*c^2))*V^2
-		lam = 12.2639 / torch.sqrt(volt + 0.97845e-6 * volt ** 2)
-		bsz = len(indexes)
-		freqs = self.freqs.repeat(bsz, 1, 1)
-		x = self.freqs[..., 0]
-		y = self.freqs[..., 1]
-		#Since we take arctan between y and x and not x and y, we are still in x ordering but x is the second coordinate now !
-		ang = torch.arctan2(y, x)
-		s2 = x ** 2 + y ** 2
-		df = 0.5 * (dfu + dfv + (dfu - dfv) * torch.cos(2 * (ang - dfang)))
-		gamma = (
-		        2 * torch.pi * (-0.5 * df * lam * s2 + 0.25 * cs * lam ** 3 * s2 ** 2)
-		        - phase_shift
-		)
-		ctf = torch.sqrt(1 - w ** 2) * torch.sin(gamma) - w * torch.cos(gamma)
-		if scalefactor is not None:
-			scalefactor = self.scalefactor[indexes]
-			ctf *= scalefactor
-		if bfactor is not None:
-			bfactor = self.bfactor[indexes]
-			ctf *= torch.exp(-bfactor / 4 * s2)
+		if self.cache_size > 0:
+			return self.compute_ctf_cached(indexes, half)
 
+		return self.compute_ctf_uncached(indexes, half)
 
-		#But in this project, the images are (y_coords, x_coords), see renderer.project so we transpose:
-		ctf = ctf.reshape((len(indexes), self.npix, self.npix))
+	def compute_ctf_uncached(self, indexes, half=False):
+		"""
+		Compute the 2D CTF from the folded parameters, see fold_parameters.
+		:param indexes: torch.tensor(batch_size) of indexes of the images in this batch.
+		:param half: bool, whether to compute the ctf on the half plane, see compute_ctf.
+		:return: torch.tensor(batch_size, npix, npix) of ctf, or torch.tensor(batch_size, npix, npix//2 + 1) if half is True.
+		"""
+		gamma_basis, s2 = (self.half_gamma_basis, self.half_s2) if half else (self.gamma_basis, self.s2)
+		gamma = self.gamma_coefficients[indexes] @ gamma_basis - self.phase_shift_rad[indexes]
+		ctf = self.sin_amplitude[indexes] * torch.sin(gamma) - self.cos_amplitude[indexes] * torch.cos(gamma)
+		ctf = ctf * torch.exp(-self.bfactor[indexes] / 4 * s2)
+		#The bases are flattened with the y frequencies along the rows and the x frequencies along the columns, so the ctf is already (y_coords, x_coords) as the images, see renderer.project.
+		ctf = ctf.reshape((len(indexes), self.npix, -1))
 		return ctf
+
+	def compute_ctf_cached(self, indexes, half=False):
+		"""
+		Compute the 2D CTF, reusing the ctf of the particles with the same parameters. The cache keeps the cache_size most recently used ctf.
+		:param indexes: torch.tensor(batch_size) of indexes of the images in this batch.
+		:param half: bool, whether to compute the ctf on the half plane, see compute_ctf.
+		:return: torch.tensor(batch_size, npix, npix) of ctf, or torch.tensor(batch_size, npix, npix//2 + 1) if half is True.
+		"""
+		groups = self.ctf_groups[indexes]
+		unique_groups, inverse = torch.unique(groups, return_inverse=True)
+		missing = [i for i, group in enumerate(unique_groups.tolist()) if (group, half) not in self.cache]
+		if missing:
+			#We compute the missing ctf from one particle of each group.
+			first_index = torch.zeros(unique_groups.shape[0], dtype=torch.long, device=groups.device)
+			first_index.scatter_(0, inverse, torch.arange(groups.shape[0], device=groups.device))
+			missing_ctf = self.compute_ctf_uncached(indexes[first_index[missing]], half)
+			for i, ctf in zip(missing, missing_ctf):
+				self.cache[(int(unique_groups[i]), half)] = ctf
+
+		unique_ctf = []
+		for group in unique_groups.tolist():
+			self.cache.move_to_end((group, half))
+			unique_ctf.append(self.cache[(group, half)])
+
+		while len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+
+		return torch.stack(unique_ctf)[inverse]
   
 
 
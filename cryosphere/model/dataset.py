@@ -1,13 +1,20 @@
 import os
+import json
 import torch
+import psutil
+import hashlib
 import mrcfile
 import starfile
 import numpy as np
-from time import time
-from torch.utils.data import Dataset
+from tqdm import tqdm
+from time import time, sleep
+from contextlib import nullcontext
+from collections import OrderedDict
+from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms.functional as tvf
 #from pytorch3d.transforms import euler_angles_to_matrix, axis_angle_to_matrix
 from roma import rotvec_to_rotmat, euler_to_rotmat
+from cryosphere.model.fourier import primal_to_fourier2d, primal_to_half_fourier2d
 
 
 
@@ -25,6 +32,69 @@ class Mask(torch.nn.Module):
         return x * self.mask
 
 
+class MrcsFilePool:
+    """
+    Least recently used pool of open memory mapped mrcs files, so that the header of a file is parsed and the file mapped only once.
+    Each process, including each data loader worker, must use its own pool.
+    """
+    def __init__(self, max_open_files=64, max_memory_percent=90.0):
+        """
+        :param max_open_files: integer, maximum number of files kept open. The least recently used file is closed beyond this number.
+        :param max_memory_percent: float, percentage of used system memory above which all the files but the one being read are closed.
+        """
+        self.max_open_files = max_open_files
+        self.max_memory_percent = max_memory_percent
+        self.files = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, mrc_path):
+        """
+        Returns an open memory map of a mrcs file, opening it if needed.
+        :param mrc_path: str, path to the mrcs file
+        :return: mrcfile.mrcmemmap.MrcMemmap object
+        """
+        mrc = self.files.get(mrc_path)
+        if mrc is not None:
+            self.hits += 1
+            self.files.move_to_end(mrc_path)
+            return mrc
+
+        self.misses += 1
+        mrc = mrcfile.mmap(mrc_path, mode="r", permissive=True)
+        self.files[mrc_path] = mrc
+        while len(self.files) > max(self.max_open_files, 1):
+            self.evict()
+
+        if psutil.virtual_memory().percent > self.max_memory_percent:
+            while len(self.files) > 1:
+                self.evict()
+
+        return mrc
+
+    def evict(self):
+        """
+        Closes the least recently used file.
+        """
+        _, mrc = self.files.popitem(last=False)
+        mrc.close()
+        self.evictions += 1
+
+    def close(self):
+        """
+        Closes all the files of the pool.
+        """
+        while self.files:
+            self.evict()
+
+    def stats(self):
+        """
+        :return: dictionnary with the number of hits, misses and evictions of the pool and the number of files currently open.
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "open_files": len(self.files)}
+
+
 def starfile_reader(starfile_path, apix):
     """
     Reads a RELION starfile for the poses
@@ -95,7 +165,8 @@ def cs_file_reader(cs_file_path, apix, abinit, hetrefine):
 
 
 class ImageDataSet(Dataset):
-    def __init__(self, apix, side_shape, star_cs_file_config, particles_path, down_side_shape=None, down_method="interp", rad_mask=None):
+    def __init__(self, apix, side_shape, star_cs_file_config, particles_path, down_side_shape=None, down_method="interp", rad_mask=None, cache_path=None,
+                 cache_dtype="float32", num_workers=0, max_open_files=64, raw_images=False):
         """
         Create a dataset of images and poses
         :param apix: float, size of a pixel in Å.
@@ -105,12 +176,20 @@ class ImageDataSet(Dataset):
         :param down_side_shape: integer, number of pixels of the downsampled images. If no downampling, set down_side_shape = side_shape. 
         :param down_method: str, downsampling method to use if down_side_shape < side_shape. Currently only interp is supported.
         :param rad_mask: float, radius of the mask used on the input image. If None, no mask is used.
+        :param cache_path: str, path to a folder in which the preprocessed images are stored as a memory mapped file. If None, no cache is used.
+        :param cache_dtype: str, "float32" or "float16", precision of the images stored in the cache.
+        :param num_workers: integer, number of workers used to build the cache.
+        :param max_open_files: integer, maximum number of mrcs files each process keeps open. If 0, each file is closed right after reading.
+        :param raw_images: boolean, if True the images are returned in float16 without downsampling, masking and normalization, which are then
+                            performed on the gpu by a utils.ImagePreprocessor. Ignored if a cache is used, since the cached images are already preprocessed.
         """
 
         self.side_shape = side_shape
         self.down_method = down_method
         self.apix = apix
         self.particles_path = particles_path
+        self.star_cs_file = star_cs_file_config["file"]
+        self.rad_mask = rad_mask
         self.mask = None
         if rad_mask is not None:
             self.mask = Mask(down_side_shape if down_side_shape is not None else side_shape, rad_mask)
@@ -119,13 +198,27 @@ class ImageDataSet(Dataset):
         assert self.pose_file_extension in ["cs", "star"], "Pose file must be a starfile or a cs file."
         if self.pose_file_extension == "star":
             self.poses, self.poses_translation = starfile_reader(star_cs_file_config["file"], self.apix)
-            self.particles_df = starfile.read(star_cs_file_config["file"])
-            if type(self.particles_df) is dict and "particles" in self.particles_df:
-                self.particles_df = self.particles_df["particles"]
+            particles_df = starfile.read(star_cs_file_config["file"])
+            if type(particles_df) is dict and "particles" in particles_df:
+                particles_df = particles_df["particles"]
+
+            #rlnImageName is of the form index@path, with indexes starting at 1.
+            image_names = particles_df["rlnImageName"].astype(str).str.split("@", n=1, expand=True)
+            stack_indexes = image_names[0].astype(np.int64).values - 1
+            file_paths, file_ids = np.unique(image_names[1].values.astype(str), return_inverse=True)
         else:
             self.poses, self.poses_translation = cs_file_reader(star_cs_file_config["file"], self.apix, star_cs_file_config.get("abinit", False), 
                                                                 star_cs_file_config.get("hetrefine", False))
-            self.particles_df = np.load(star_cs_file_config["file"])
+            particles_df = np.load(star_cs_file_config["file"])
+            stack_indexes = np.asarray(particles_df["blob/idx"], dtype=np.int64)
+            #The paths are decoded once per file instead of once per particle.
+            file_paths, file_ids = np.unique(particles_df["blob/path"], return_inverse=True)
+            file_paths = [path.decode('ascii').replace(">", "") for path in file_paths]
+
+        #The location of each image is stored as compact arrays, so that fetching an image does not involve any dataframe or string operation.
+        self.particle_stack_indexes = stack_indexes
+        self.particle_file_ids = file_ids.reshape(-1).astype(np.int32)
+        self.mrc_paths = [os.path.join(self.particles_path, path) for path in file_paths]
 
 
         print("Dataset size:", self.poses.shape[0], "apix:",self.apix)
@@ -138,65 +231,226 @@ class ImageDataSet(Dataset):
             self.down_side_shape = down_side_shape
             self.down_apix = self.side_shape * self.apix /self.down_side_shape
 
+        self.max_open_files = max_open_files
+        self.raw_images = False
+        self._file_pool = None
+        self._file_pool_pid = None
+        self.cache_file = None
+        self._cache = None
         self.f_std = None
         self.f_mu = None
         self.estimate_normalization()
 
-    def estimate_normalization(self):
-        if self.f_mu is None and self.f_std is None:
-            f_sub_data = []
-            # I have checked that the standard deviation of 10/100/1000 particles is similar
-            for i in range(0, len(self), len(self) // 100):
-                _, _, _, _, fproj = self[i]
-                f_sub_data.append(fproj)
+        if cache_path is not None:
+            self.cache_file = self.build_cache(cache_path, cache_dtype, num_workers)
 
-            f_sub_data = torch.cat(f_sub_data, dim=0)
-            self.f_mu = 0.0  # just follow cryodrgn
-            self.f_std = torch.std(f_sub_data).item()
-            print("Estimated std", self.f_std)
-        else:
+        self.raw_images = raw_images and self.cache_file is None
+
+    def estimate_normalization(self, n_samples=100, batch_size=32):
+        """
+        Estimates the standard deviation of the Fourier coefficients of the images, used to normalize them. The value is read from the normalization
+        file next to the star/cs file if it has already been estimated with the same preprocessing. Otherwise it is estimated on a stratified
+        random sample of images, read by batches, with a running variance, and saved to the normalization file.
+        :param n_samples: integer, number of images used for the estimation.
+        :param batch_size: integer, number of images read at once.
+        """
+        if self.f_mu is not None or self.f_std is not None:
             raise Exception("The normalization factor has been estimated!")
 
+        key = self.preprocessing_key()
+        normalization_file = os.path.splitext(self.star_cs_file)[0] + "_normalization.json"
+        normalizations = {}
+        if os.path.exists(normalization_file):
+            with open(normalization_file, "r") as file:
+                normalizations = json.load(file)
+
+        if key in normalizations:
+            self.f_mu = 0.0  # just follow cryodrgn
+            self.f_std = normalizations[key]
+            print("Using std from", normalization_file, self.f_std)
+            return
+
+        # I have checked that the standard deviation of 10/100/1000 particles is similar
+        #We draw one image uniformly at random in each of n_samples strata of the dataset, so that the sample spans all the mrcs files.
+        n_samples = min(n_samples, len(self))
+        strata = np.linspace(0, len(self), n_samples + 1).astype(np.int64)
+        indexes = np.random.default_rng(0).integers(strata[:-1], strata[1:])
+        count = 0
+        mean = torch.zeros((), dtype=torch.complex128)
+        sum_squares = torch.zeros((), dtype=torch.float64)
+        for batch_indexes in np.split(indexes, range(batch_size, n_samples, batch_size)):
+            proj, _ = self.preprocess(self.read_images(batch_indexes))
+            fproj = primal_to_fourier2d(proj).to(torch.complex128).flatten()
+            #Merge the batch statistics into the running ones (Chan et al. parallel version of Welford's algorithm).
+            batch_count = fproj.shape[0]
+            batch_mean = fproj.mean()
+            batch_sum_squares = torch.sum(torch.abs(fproj - batch_mean)**2)
+            delta = batch_mean - mean
+            mean = mean + delta * batch_count / (count + batch_count)
+            sum_squares = sum_squares + batch_sum_squares + torch.abs(delta)**2 * count * batch_count / (count + batch_count)
+            count += batch_count
+
+        self.f_mu = 0.0  # just follow cryodrgn
+        self.f_std = torch.sqrt(sum_squares / (count - 1)).item()
+        print("Estimated std", self.f_std)
+        normalizations[key] = self.f_std
+        try:
+            #The file is written atomically since several processes may estimate the normalization at the same time.
+            tmp_normalization_file = f"{normalization_file}.{os.getpid()}.tmp"
+            with open(tmp_normalization_file, "w") as file:
+                json.dump(normalizations, file, indent=4)
+
+            os.replace(tmp_normalization_file, normalization_file)
+        except OSError as error:
+            print("Could not save the normalization to", normalization_file, ":", error)
+
     def standardize(self, images, device="cpu"):
         return (images - self.avg_image.to(device))/self.std_image.to(device)
 
+    def preprocessing_key(self, *extra_values):
+        """
+        Computes a key identifying the star/cs file, the particles path and all the preprocessing parameters, so that values computed
+        with different settings are never reused.
+        :param extra_values: additional values to include in the key.
+        :return: str, hash of the key
+        """
+        star_cs_file = os.path.abspath(self.star_cs_file)
+        star_cs_stat = os.stat(star_cs_file)
+        key = "_".join(str(value) for value in [star_cs_file, star_cs_stat.st_size, star_cs_stat.st_mtime_ns, os.path.abspath(self.particles_path),
+                                                 self.side_shape, self.down_side_shape, self.down_method, self.rad_mask, *extra_values])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def cache_file_name(self, cache_path, cache_dtype):
+        """
+        Computes the name of the cache file. The name is keyed by the preprocessing and by the normalization, see preprocessing_key.
+        :param cache_path: str, path to the folder containing the cache files.
+        :param cache_dtype: str, precision of the images stored in the cache.
+        :return: str, path to the cache file.
+        """
+        key_hash = self.preprocessing_key(repr(self.f_mu), repr(self.f_std), cache_dtype)
+        name = os.path.splitext(os.path.basename(self.star_cs_file))[0]
+        return os.path.join(cache_path, f"{name}_{self.down_side_shape}_{key_hash}.npy")
+
+    def build_cache(self, cache_path, cache_dtype="float32", num_workers=0, batch_size=256):
+        """
+        Preprocesses all the images once and writes them to a single contiguous memory mapped file. If the file already exists, it is reused.
+        When running on several gpus, only the process of rank 0 builds the cache while the others wait for it.
+        :param cache_path: str, path to the folder containing the cache files.
+        :param cache_dtype: str, "float32" or "float16", precision of the images stored in the cache.
+        :param num_workers: integer, number of workers used to read the images.
+        :param batch_size: integer, number of images preprocessed at once.
+        :return: str, path to the cache file.
+        """
+        assert cache_dtype in ["float32", "float16"], "The cache can only be stored in float32 or float16."
+        os.makedirs(cache_path, exist_ok=True)
+        cache_file = self.cache_file_name(cache_path, cache_dtype)
+        if os.path.exists(cache_file):
+            print("Using cached images:", cache_file)
+            return cache_file
+
+        rank = 0
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank = torch.distributed.get_rank()
+
+        if rank != 0:
+            #The cache can take a long time to build, so we poll the file system instead of using a barrier that could time out.
+            while not os.path.exists(cache_file):
+                sleep(5)
+
+            return cache_file
+
+        print("Building cache of preprocessed images:", cache_file)
+        tmp_cache_file = f"{cache_file}.{os.getpid()}.tmp"
+        cache = np.lib.format.open_memmap(tmp_cache_file, mode="w+", dtype=cache_dtype, shape=(len(self), self.down_side_shape, self.down_side_shape))
+        data_loader = DataLoader(self, batch_size=batch_size, shuffle=False, num_workers=num_workers, drop_last=False)
+        for indexes, images, _, _, _ in tqdm(data_loader):
+            cache[indexes.numpy()] = images.numpy().astype(cache_dtype)
+
+        cache.flush()
+        del cache
+        #The renaming is atomic, so a partially written cache is never used.
+        os.replace(tmp_cache_file, cache_file)
+        return cache_file
+
+    def get_cache(self):
+        """
+        Opens the cache file as a read only memory map. The memory map is opened lazily so that each data loader worker opens its own.
+        :return: np.memmap(N_images, down_side_shape, down_side_shape) of preprocessed images
+        """
+        if self._cache is None:
+            self._cache = np.load(self.cache_file, mmap_mode="r")
+
+        return self._cache
+
+    def get_file_pool(self):
+        """
+        Returns the pool of open mrcs files of the current process. A forked data loader worker inherits the pool of its parent, so a new pool is
+        created whenever the process changes.
+        :return: MrcsFilePool object
+        """
+        if self._file_pool is None or self._file_pool_pid != os.getpid():
+            self._file_pool = MrcsFilePool(self.max_open_files)
+            self._file_pool_pid = os.getpid()
+
+        return self._file_pool
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        #Memory maps are not sent to the workers, they reopen the files instead.
+        state["_cache"] = None
+        state["_file_pool"] = None
+        state["_file_pool_pid"] = None
+        return state
+
     def __len__(self):
-        return self.particles_df.shape[0]
+        return self.particle_file_ids.shape[0]
 
-    def __getitem__(self, idx):
+    def particle_location(self, idx):
         """
-        #Return a batch of true images, as 2d array
-        # return: the set of indexes queried for the batch, the corresponding images as a torch.tensor((batch_size, side_shape, side_shape)), 
-        # the corresponding poses rotation matrices as torch.tensor((batch_size, 3, 3)), the corresponding poses translations as torch.tensor((batch_size, 2))
-        # NOTA BENE: the convention for the rotation matrix is left multiplication of the coordinates of the atoms of the protein !!
+        Finds where an image is stored.
+        :param idx: integer, index of the image in the dataset
+        :return: str, path to the mrcs file containing the image and integer, index of the image in this mrcs file.
         """
-        #try:
-        if self.pose_file_extension == "star":
-            particles = self.particles_df.iloc[idx]
-            mrc_idx, img_name = particles["rlnImageName"].split("@")
-            mrc_idx = int(mrc_idx) - 1
-        else:
-            particles = self.particles_df[idx]
-            mrc_idx = particles["blob/idx"]
-            if type(idx) != list:
-                img_name = particles["blob/path"].decode('ascii').replace(">", "")
-            else:
-                img_name = [s.decode('ascii').replace(">", "") for s in particles["blob/path"]]
+        return self.mrc_paths[self.particle_file_ids[idx]], int(self.particle_stack_indexes[idx])
 
-        mrc_path = os.path.join(self.particles_path, img_name)
-        with mrcfile.mmap(mrc_path, mode="r", permissive=True) as mrc:
-            if mrc.data.ndim > 2:
-                proj = torch.from_numpy(np.array(mrc.data[mrc_idx])).float() #* self.cfg.scale_images
-            else:
+    def read_images(self, indexes):
+        """
+        Reads raw images from the mrcs files. The images are grouped by mrcs file so that each file is opened once, and runs of
+        consecutive images in a file are read with a single slice.
+        :param indexes: list of integers, indexes of the images in the dataset
+        :return: torch.tensor(N_images, side_shape, side_shape) of raw images, in the order of indexes
+        """
+        file_ids = self.particle_file_ids[indexes]
+        mrc_idx = self.particle_stack_indexes[indexes]
+        images = np.empty((len(indexes), self.side_shape, self.side_shape), dtype=np.float32)
+        #Sort by file first and then by position in the file.
+        order = np.lexsort((mrc_idx, file_ids))
+        file_starts = np.flatnonzero(np.r_[True, file_ids[order][1:] != file_ids[order][:-1]])
+        file_pool = self.get_file_pool()
+        for group in np.split(order, file_starts[1:]):
+            mrc = file_pool.get(self.mrc_paths[file_ids[group[0]]])
+            if mrc.data.ndim == 2:
                 # the mrcs file can contain only one particle
-                proj = torch.from_numpy(np.array(mrc.data)).float() #* self.cfg.scale_images
+                images[group] = mrc.data
+            else:
+                #Split the sorted positions of this file into runs of consecutive images.
+                group_idx = mrc_idx[group]
+                run_starts = np.flatnonzero(np.r_[True, np.diff(group_idx) != 1])
+                for run in np.split(np.arange(len(group)), run_starts[1:]):
+                    images[group[run]] = mrc.data[group_idx[run[0]]:group_idx[run[-1]]+1].reshape(-1, self.side_shape, self.side_shape)
 
-        # get (1, side_shape, side_shape) proj
-        if len(proj.shape) == 2:
-            proj = proj[None, :, :]  # add a dummy channel (for consistency w/ img fmt)
-        else:
-            assert len(proj.shape) == 3 and proj.shape[0] == 1  # some starfile already have a dummy channel
+        if self.max_open_files == 0:
+            file_pool.close()
+
+        return torch.from_numpy(images)
 
+    def preprocess(self, proj):
+        """
+        Downsamples, masks and normalizes a batch of images.
+        :param proj: torch.tensor(N_images, side_shape, side_shape) of raw images
+        :return: torch.tensor(N_images, down_side_shape, down_side_shape) of images and
+                torch.tensor(N_images, down_side_shape, down_side_shape//2 + 1) of their half plane fourier transforms, see fourier.primal_to_half_fourier2d.
+        """
         if self.down_side_shape != self.side_shape:
             if self.down_method == "interp":
                 proj = tvf.resize(proj, [self.down_side_shape, ] * 2, antialias=True)
@@ -205,38 +459,118 @@ class ImageDataSet(Dataset):
             else:
                 raise NotImplementedError            
 
-        proj = proj[0]
         if self.mask is not None:
             proj = self.mask(proj)
 
-        fproj = primal_to_fourier_2d(proj)
         if self.f_mu is not None:
-            fproj = (fproj - self.f_mu) / self.f_std
-            proj = fourier_to_primal_2d(fproj).real
+            #f_mu is always 0, so normalizing the fourier transform is the same as normalizing the image.
+            proj = proj / self.f_std
 
-        return idx, proj, self.poses[idx], self.poses_translation[idx]/self.down_apix, fproj
+        fproj = primal_to_half_fourier2d(proj)
+        return proj, fproj
 
+    def __getitem__(self, idx):
+        """
+        #Return a batch of true images, as 2d array
+        # return: the set of indexes queried for the batch, the corresponding images as a torch.tensor((batch_size, side_shape, side_shape)), 
+        # the corresponding poses rotation matrices as torch.tensor((batch_size, 3, 3)), the corresponding poses translations as torch.tensor((batch_size, 2))
+        # NOTA BENE: the convention for the rotation matrix is left multiplication of the coordinates of the atoms of the protein !!
+        """
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indexes):
+        """
+        Fetches a batch of images at once. The data loader calls this method instead of __getitem__, so that the images are read
+        file by file and preprocessed as a single batch.
+        :param indexes: list of integers, indexes of the images in the batch
+        :return: list of tuples (index, image, pose rotation, pose translation, half plane fourier transform of the image), one per index.
+                If the dataset returns raw images, the images are not preprocessed and the fourier transforms are empty tensors.
+        """
+        if self.raw_images:
+            #float16 halves the memory traffic between the workers and the gpu.
+            proj = self.read_images(indexes).to(torch.float16)
+            fproj = torch.empty((len(indexes), 0))
+        elif self.cache_file is not None:
+            #Reading the memory map in increasing order is much faster on disk.
+            order = np.argsort(indexes)
+            proj = torch.empty((len(indexes), self.down_side_shape, self.down_side_shape), dtype=torch.float32)
+            proj[torch.from_numpy(order)] = torch.from_numpy(np.array(self.get_cache()[np.asarray(indexes)[order]], dtype=np.float32))
+            fproj = primal_to_half_fourier2d(proj)
+        else:
+            proj, fproj = self.preprocess(self.read_images(indexes))
 
+        poses = self.poses[indexes]
+        poses_translation = self.poses_translation[indexes]/self.down_apix
+        return [(idx, proj[i], poses[i], poses_translation[i], fproj[i]) for i, idx in enumerate(indexes)]
 
-def primal_to_fourier_2d(images):
-    """
-    Computes the fourier transform of the images.
-    images: torch.tensor(batch_size, N_pix, N_pix)
-    return fourier transform of the images
-    """
-    r = torch.fft.ifftshift(images, dim=(-2, -1))
-    fourier_images = torch.fft.fftshift(torch.fft.fft2(r, dim=(-2, -1), s=(r.shape[-2], r.shape[-1])), dim=(-2, -1))
-    return fourier_images
 
-def fourier_to_primal_2d(fourier_images):
+class DevicePrefetcher:
     """
-    Computes the inverse fourier transform
-    fourier_images: torch.tensor(batch_size, N_pix, N_pix)
-    return fourier transform of the images
+    Iterates over a data loader and copies the batches to the device one step ahead. On gpu, the next batch is copied from pinned memory
+    on a side stream while the current batch is processed, so the copy overlaps with the computations. The time spent waiting for the
+    data loader workers is recorded for each step, to see when reading the images is the bottleneck.
     """
-    f = torch.fft.ifftshift(fourier_images, dim=(-2, -1))
-    r = torch.fft.fftshift(torch.fft.ifft2(f, dim=(-2, -1), s=(f.shape[-2], f.shape[-1])),dim=(-2, -1)).real
-    return r
+    def __init__(self, data_loader, device, copy_items=None):
+        """
+        :param data_loader: torch DataLoader, created with pin_memory=True for the copies to be asynchronous.
+        :param device: torch device on which the batches are copied.
+        :param copy_items: list of integers, positions of the tensors of a batch to copy to the device. If None, all of them are copied.
+        """
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.copy_items = copy_items
+        self.stream = None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
 
+        self.wait_times = []
+        self.last_wait = None
 
+    def __len__(self):
+        return len(self.data_loader)
 
+    def load(self, iterator):
+        """
+        Fetches the next batch of the data loader and starts its copy to the device.
+        :param iterator: iterator over the data loader.
+        :return: list of the elements of the batch, or None at the end of the data loader.
+        """
+        start = time()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+
+        self.wait_times.append(time() - start)
+        copy_items = range(len(batch)) if self.copy_items is None else self.copy_items
+        batch = list(batch)
+        stream_context = torch.cuda.stream(self.stream) if self.stream is not None else nullcontext()
+        with stream_context:
+            for i in copy_items:
+                batch[i] = batch[i].to(self.device, non_blocking=True)
+
+        return batch
+
+    def __iter__(self):
+        """
+        Yields the batches on the device. The wait times of the previous epoch are reset. When a batch is yielded, last_wait is the time spent
+        waiting for the data loader since the previous batch was yielded, that is during the training step that just ended.
+        """
+        self.wait_times = []
+        counted_waits = 0
+        iterator = iter(self.data_loader)
+        next_batch = self.load(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                #The current stream waits for the copy, and the memory of the batch is not reused by the side stream before the current stream is done with it.
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                for i in range(len(batch)):
+                    if isinstance(batch[i], torch.Tensor) and batch[i].is_cuda:
+                        batch[i].record_stream(torch.cuda.current_stream(self.device))
+
+            next_batch = self.load(iterator)
+            #The next batch is fetched before the current one is yielded, so the waits since the previous yield are not those of the current batch.
+            self.last_wait = sum(self.wait_times[counted_waits:])
+            counted_waits = len(self.wait_times)
+            yield batch
@@ -0,0 +1,73 @@
+import torch
+
+
+def primal_to_fourier2d(images):
+    """
+    Computes the fourier transform of the images, with the zero frequency at the center.
+    images: torch.tensor(batch_size, N_pix, N_pix)
+    return: torch.tensor(batch_size, N_pix, N_pix) fourier transform of the images
+    """
+    r = torch.fft.ifftshift(images, dim=(-2, -1))
+    fourier_images = torch.fft.fftshift(torch.fft.fft2(r, dim=(-2, -1), s=(r.shape[-2], r.shape[-1])), dim=(-2, -1))
+    return fourier_images
+
+def fourier2d_to_primal(fourier_images):
+    """
+    Computes the inverse fourier transform of fourier transforms with the zero frequency at the center.
+    fourier_images: torch.tensor(batch_size, N_pix, N_pix)
+    return: torch.tensor(batch_size, N_pix, N_pix) images in real space
+    """
+    f = torch.fft.ifftshift(fourier_images, dim=(-2, -1))
+    r = torch.fft.fftshift(torch.fft.ifft2(f, dim=(-2, -1), s=(f.shape[-2], f.shape[-1])),dim=(-2, -1)).real
+    return r
+
+
+def primal_to_half_fourier2d(images):
+    """
+    Computes the half plane fourier transform of real images. The frequencies are not shifted: the rows follow torch.fft.fftfreq
+    and the columns torch.fft.rfftfreq, see half_frequencies.
+    images: torch.tensor(batch_size, N_pix, N_pix)
+    return: torch.tensor(batch_size, N_pix, N_pix//2 + 1) half plane fourier transform of the images
+    """
+    return torch.fft.rfft2(images, dim=(-2, -1))
+
+def half_fourier2d_to_primal(fourier_images, side_shape):
+    """
+    Computes the inverse of primal_to_half_fourier2d.
+    fourier_images: torch.tensor(batch_size, N_pix, N_pix//2 + 1)
+    side_shape: integer, number of pixels on each side of the images, needed because N_pix//2 + 1 is the same for N_pix even and odd.
+    return: torch.tensor(batch_size, N_pix, N_pix) images in real space
+    """
+    return torch.fft.irfft2(fourier_images, s=(side_shape, side_shape), dim=(-2, -1))
+
+
+def half_frequencies(side_shape, apix=1., device=None):
+    """
+    Frequencies of the half plane fourier transform.
+    side_shape: integer, number of pixels on each side of the images.
+    apix: float, size of a pixel.
+    device: torch device on which the frequencies are created.
+    return: torch.tensor(N_pix) frequencies along the rows and torch.tensor(N_pix//2 + 1) frequencies along the columns.
+    """
+    return torch.fft.fftfreq(side_shape, apix, device=device), torch.fft.rfftfreq(side_shape, apix, device=device)
+
+
+def centered_to_half(filter2d):
+    """
+    Converts a real filter with the zero frequency at the center, as used with primal_to_fourier2d, into a half plane filter as used with
+    primal_to_half_fourier2d. The filter must be symmetric with respect to the zero frequency, like the low pass masks and the ctf.
+    filter2d: torch.tensor(..., N_pix, N_pix)
+    return: torch.tensor(..., N_pix, N_pix//2 + 1)
+    """
+    return torch.fft.ifftshift(filter2d, dim=(-2, -1))[..., :filter2d.shape[-1]//2 + 1]
+
+
+def apply_filter(images, half_filter2d):
+    """
+    Multiplies the fourier transform of real images by a half plane filter, in a single half plane fourier transform round trip.
+    A filter is a convolution, which commutes with the shifts of primal_to_fourier2d, so the images do not need to be shifted.
+    images: torch.tensor(batch_size, N_pix, N_pix)
+    half_filter2d: torch.tensor(N_pix, N_pix//2 + 1) or torch.tensor(batch_size, N_pix, N_pix//2 + 1), see centered_to_half.
+    return: torch.tensor(batch_size, N_pix, N_pix) filtered images.
+    """
+    return half_fourier2d_to_primal(primal_to_half_fourier2d(images)*half_filter2d, images.shape[-1])
@@ -2,7 +2,7 @@ import torch
 import numpy as np
 from torch import linalg as LA
 import torch.nn.functional as F
-from scipy.spatial import distance
+from scipy.spatial import cKDTree
 
 
 
@@ -205,10 +205,18 @@ def find_range_cutoff_pairs(coord_arr, min_cutoff=4., max_cutoff=10.):
     :param max_cutoff: maximum cutoff to consider the pair the clashing loss
     return np.array(N_pairs, 2) pairs of residues considered for the clashing loss
     """
-    dist_map = distance.cdist(coord_arr, coord_arr, metric='euclidean')
-    sel_mask = (dist_map <= max_cutoff) & (dist_map >= min_cutoff)
-    indices_in_pdb = np.nonzero(sel_mask)
-    indices_in_pdb = np.column_stack((indices_in_pdb[0], indices_in_pdb[1]))
+    #Only the pairs closer than max_cutoff are found, so the memory is proportional to the number of pairs instead of N_residues**2.
+    tree = cKDTree(coord_arr)
+    pairs = tree.query_pairs(max_cutoff, output_type="ndarray")
+    distances = np.linalg.norm(coord_arr[pairs[:, 0]] - coord_arr[pairs[:, 1]], axis=-1)
+    pairs = pairs[distances >= min_cutoff]
+    #query_pairs returns each pair once with i < j, we return both orders, sorted, as a dense distance map would.
+    indices_in_pdb = [pairs, np.flip(pairs, 1)]
+    if min_cutoff <= 0:
+        indices_in_pdb.append(np.repeat(np.arange(coord_arr.shape[0])[:, None], 2, axis=1))
+
+    indices_in_pdb = np.concatenate(indices_in_pdb).astype(np.int64)
+    indices_in_pdb = indices_in_pdb[np.lexsort((indices_in_pdb[:, 1], indices_in_pdb[:, 0]))]
     return indices_in_pdb
 
 
@@ -222,22 +230,16 @@ def remove_duplicate_pairs(pairs_a, pairs_b, remove_flip=True):
     """
     """Remove pair b from a"""
     s = max(pairs_a.max(), pairs_b.max()) + 1
-    # trick for fast comparison
-    mask = np.zeros((s, s), dtype=bool)
-
-    #np.ravel_multi_index gets the index of the elements in non linear shape as if the array was linear
-    #so ravel_multi_index(pairs_a.T, mask.shape) get the indexes of the elements in the pair as if mask was linear
-    #So the next line sets all the values of the mask array where the indexes are in pairs_a to True
-    np.put(mask, np.ravel_multi_index(pairs_a.T, mask.shape), True)
-    #This line set all the values of the mask array where the indexes are in pairs_b to False. This step is needed so that pairs in a that are also
-    #in b are set to False
-    np.put(mask, np.ravel_multi_index(pairs_b.T, mask.shape), False)
+    # trick for fast comparison: each pair (x, y) is encoded as the integer x*s + y, and we take the sorted set difference of the keys.
+    keys_a = pairs_a[:, 0].astype(np.int64) * s + pairs_a[:, 1]
+    keys_b = pairs_b[:, 0].astype(np.int64) * s + pairs_b[:, 1]
     if remove_flip:
-        #This line does the same thing except we first flip the coordinates in pairs_b, so we get both (x, y) and (y, x) to False
-        np.put(mask, np.ravel_multi_index(np.flip(pairs_b, 1).T, mask.shape), False)
+        #We also remove the flipped pairs of b, so we get both (x, y) and (y, x) removed
+        keys_b = np.concatenate([keys_b, pairs_b[:, 1].astype(np.int64) * s + pairs_b[:, 0]])
 
-    #Finally, we return the non False elements, e.g the pairs in a that are not in b.
-    return np.column_stack(np.nonzero(mask))
+    #Finally, we return the pairs in a that are not in b, sorted.
+    keys = np.setdiff1d(keys_a, keys_b)
+    return np.column_stack((keys // s, keys % s))
 
 
 def calc_cor_loss(pred_images, gt_images, mask=None):
@@ -268,6 +270,37 @@ def calc_cor_loss(pred_images, gt_images, mask=None):
     err = err.mean() / pixel_num
     return err
 
+
+def calc_std_fourier(fourier_images):
+    """
+    Compute the standard deviation of the pixels of images from their fourier transforms, using Parseval's theorem.
+    fourier_images: torch.tensor(batch_size, side_shape, side_shape) complex fourier transforms of the images, in the centered order of primal_to_fourier2d.
+    return torch.tensor(batch_size) of standard deviations, with the same unbiased estimator as torch.std.
+    """
+    side_shape = fourier_images.shape[-1]
+    pixel_num = fourier_images.shape[-2] * fourier_images.shape[-1]
+    #The means of the images are given by the zero frequency, at the center.
+    mean = fourier_images[:, side_shape//2, side_shape//2].real / pixel_num
+    sum_squares = (fourier_images.real**2 + fourier_images.imag**2).sum(dim=(-2, -1)) / pixel_num
+    return torch.sqrt((sum_squares - pixel_num * mean**2) / (pixel_num - 1))
+
+
+def calc_cor_loss_fourier(pred_images, gt_images):
+    """
+    Compute the same correlation loss as calc_cor_loss, without mask, from the fourier transforms of the images using Parseval's theorem.
+    pred_images: torch.tensor(batch_size, side_shape, side_shape) complex fourier transforms of the predicted images, in the centered order of primal_to_fourier2d.
+    gt_images: torch.tensor(batch_size, side_shape, side_shape) complex fourier transforms of the true images, translated according to the poses.
+    return torch.tensor(1) of average correlation accross the batch.
+    """
+    pixel_num = pred_images.shape[-2] * pred_images.shape[-1]
+    # b 
+    dots = (pred_images * gt_images.conj()).real.sum(dim=(-2, -1)) / pixel_num
+    # b -> b 
+    err = -dots / (calc_std_fourier(gt_images) + 1e-5) / (calc_std_fourier(pred_images) + 1e-5)
+    # b -> 1 value
+    err = err.mean() / pixel_num
+    return err
+
 def compute_KL_prior_latent(latent_mean, latent_std, epsilon_loss):
     """
     Computes the KL divergence between the approximate posterior and the prior over the latent variable z,
@@ -341,8 +374,121 @@ def compute_clashing_distances(new_structures, device, cutoff=4):
     return torch.mean(average_clahing)
 
 
+class ClashNeighborList:
+    """
+    Verlet neighbor list of the pairs of residues that may clash, for the full clashing loss. The pairs are found with a cell list, so the memory
+    and the time grow linearly with the number of residues. The list contains the pairs (i, j), j >= i + 2, closer than cutoff + skin in at least
+    one of the structures of the batch used to build it, the reference structures. Since the batches are shuffled, a structure is not compared
+    to the reference structure at the same position in the batch but to the closest one: if every residue of the structure is within skin/2
+    of that reference structure, all its pairs closer than cutoff are in the list. Otherwise, or every rebuild_every steps, the list is rebuilt,
+    so that no pair closer than cutoff is ever missed.
+    """
+    def __init__(self, cutoff=4.0, skin=2.0, rebuild_every=10):
+        """
+        :param cutoff: float, distance in Å under which two residues are clashing.
+        :param skin: float, margin in Å added to the cutoff when building the list.
+        :param rebuild_every: integer, maximum number of steps between two builds of the list.
+        """
+        self.cutoff = cutoff
+        self.skin = skin
+        self.rebuild_every = rebuild_every
+        self.pairs = None
+        self.reference_structures = None
+        self.steps_since_build = 0
+        self.n_builds = 0
+
+    def needs_rebuild(self, structures):
+        """
+        Checks whether the list must be rebuilt for these structures.
+        :param structures: torch.tensor(N_batch, N_residues, 3) of structures.
+        :return: bool
+        """
+        if self.pairs is None or self.steps_since_build >= self.rebuild_every or self.reference_structures.shape[1:] != structures.shape[1:]:
+            return True
+
+        #Largest displacement of the residues of each structure from its closest reference structure. The reference structures are looped
+        #over so that the memory stays proportional to the size of the batch.
+        structures = structures.detach()
+        displacements = torch.full((structures.shape[0],), torch.inf, dtype=structures.dtype, device=structures.device)
+        for reference_structure in self.reference_structures:
+            displacements = torch.minimum(displacements, torch.amax(LA.vector_norm(structures - reference_structure, dim=-1), dim=-1))
+
+        #A single boolean is copied to the host, this is the only synchronization of the device when the list is reused.
+        return bool(torch.any(displacements >= self.skin / 2))
+
+    def build(self, structures):
+        """
+        Finds all the pairs (i, j), j >= i + 2, closer than cutoff + skin in at least one structure, with a cell list of cells of side cutoff + skin.
+        :param structures: torch.tensor(N_batch, N_residues, 3) of structures.
+        :return: torch.tensor(N_pairs, 2) of pairs of residues.
+        """
+        structures = structures.detach()
+        batch_size, N_residues, _ = structures.shape
+        device = structures.device
+        radius = self.cutoff + self.skin
+        cells = torch.floor((structures - structures.amin(dim=1, keepdim=True)) / radius).long()
+        #One more cell on each side so that the neighbouring cells are never out of the grid.
+        cells += 1
+        grid_shape = cells.amax(dim=(0, 1)) + 2
+        strides = torch.tensor([grid_shape[1]*grid_shape[2], grid_shape[2], 1], device=device)
+        N_cells = int(torch.prod(grid_shape))
+        batch_offsets = torch.arange(batch_size, device=device)[:, None] * N_cells
+        keys = (torch.sum(cells * strides, dim=-1) + batch_offsets).flatten()
+        sorted_keys, order = torch.sort(keys)
+        residues = torch.arange(N_residues, device=device).repeat(batch_size)
+        flat_structures = structures.reshape(-1, 3)
+        all_pairs = []
+        for offset in torch.cartesian_prod(*[torch.arange(-1, 2, device=device)]*3):
+            #Residues in the neighbouring cell: they are contiguous in the sorted keys.
+            neighbour_keys = keys + torch.sum(offset * strides)
+            start = torch.searchsorted(sorted_keys, neighbour_keys, side="left")
+            end = torch.searchsorted(sorted_keys, neighbour_keys, side="right")
+            counts = end - start
+            first = torch.repeat_interleave(torch.arange(keys.shape[0], device=device), counts)
+            positions_in_cell = torch.arange(first.shape[0], device=device) - torch.repeat_interleave(torch.cumsum(counts, dim=0) - counts, counts)
+            second = order[start[first] + positions_in_cell]
+            keep = (residues[second] >= residues[first] + 2) 
+            first = first[keep]
+            second = second[keep]
+            keep = LA.vector_norm(flat_structures[first] - flat_structures[second], dim=-1) < radius
+            all_pairs.append(residues[first[keep]] * N_residues + residues[second[keep]])
+
+        pair_keys = torch.unique(torch.cat(all_pairs))
+        self.pairs = torch.stack([pair_keys // N_residues, pair_keys % N_residues], dim=-1)
+        self.reference_structures = structures.clone()
+        self.steps_since_build = 0
+        self.n_builds += 1
+        return self.pairs
+
+    def update(self, structures):
+        """
+        Returns the pairs that may clash, rebuilding the list if needed.
+        :param structures: torch.tensor(N_batch, N_residues, 3) of structures.
+        :return: torch.tensor(N_pairs, 2) of pairs of residues.
+        """
+        if self.needs_rebuild(structures):
+            self.build(structures)
+
+        self.steps_since_build += 1
+        return self.pairs
+
+    def clashing_loss(self, new_structures):
+        """
+        Computes the same clashing loss as compute_clashing_distances, restricted to the pairs of the neighbor list.
+        :param new_structures: torch.tensor(N_batch, N_residues, 3), atom positions
+        :return: torch.tensor(1, ) of the averaged clashing distance for distance inferior to cutoff, reaverage over the batch dimension
+        """
+        pairs = self.update(new_structures)
+        distances = LA.vector_norm(new_structures[:, pairs[:, 0]] - new_structures[:, pairs[:, 1]], dim=-1)
+        #Unlike the dense version, a batch element without any clash contributes 0 instead of nan.
+        number_clash_per_sample = torch.clamp(torch.sum(distances < self.cutoff, dim=-1), min=1)
+        distances = torch.minimum((distances - self.cutoff), torch.zeros_like(distances))**2
+        average_clahing = torch.sum(distances, dim=-1)/number_clash_per_sample
+        return torch.mean(average_clahing)
+
+
 def compute_loss(predicted_images, images, segmentation_image, latent_mean, latent_std, vae, segmenter, experiment_settings, tracking_dict, structural_loss_parameters,
-                 epoch, predicted_structures = None, device=None):
+                 epoch, predicted_structures = None, device=None, fourier=False):
     """
     Compute the entire loss
     :param predicted_images: torch.tensor(batch_size, N_pix), predicted images
@@ -352,14 +498,19 @@ def compute_loss(predicted_images, images, segmentation_image, latent_mean, late
     :param segmenter: object of the class VAE.
     :param segmenter: object of the class Segmentation.
     :param experiment_settings: dictionnary with the settings of the current experiment
-    :param tracking_dict: dictionnary containing the different metrics we want to track
+    :param tracking_dict: dictionnary containing the different metrics we want to track, accumulated by the utils.MetricsAccumulator under the key "metrics".
     :param structural_loss_parameters: dictionnary containing all that is required to compute the structural loss, such as the pairs for clashing loss, continuity loss and
                                         the target distances.
     :param predicted_structures: torch.tensor(N_batch, N_residues, 3) of predicted structures to compute the structural losses.
     :param device: torch device on which we perform the computations.
+    :param fourier: bool, whether the predicted and true images are given as their fourier transforms, see calc_cor_loss_fourier.
     :return: torch.float32, average loss over the batch dimension
     """
-    rmsd = calc_cor_loss(predicted_images, images, segmentation_image)
+    if fourier:
+        assert segmentation_image is None, "The correlation loss in fourier space does not support a mask."
+        rmsd = calc_cor_loss_fourier(predicted_images, images)
+    else:
+        rmsd = calc_cor_loss(predicted_images, images, segmentation_image)
     KL_prior_latent = compute_KL_prior_latent(latent_mean, latent_std, experiment_settings["epsilon_kl"])
     KL_prior_segmentation_means = compute_KL_prior_segments(
         segmenter, experiment_settings["segmentation_prior"],
@@ -368,7 +519,9 @@ def compute_loss(predicted_images, images, segmentation_image, latent_mean, late
     continuity_loss = calc_pair_dist_loss(predicted_structures, structural_loss_parameters["connect_pairs"], 
         structural_loss_parameters["connect_distances"])
 
-    if structural_loss_parameters["clash_pairs"] is None:
+    if structural_loss_parameters.get("clash_neighbor_list") is not None:
+        clashing_loss = structural_loss_parameters["clash_neighbor_list"].clashing_loss(predicted_structures)
+    elif structural_loss_parameters["clash_pairs"] is None:
         clashing_loss = compute_clashing_distances(predicted_structures, device, cutoff=experiment_settings["loss"]["clashing_loss"]["clashing_cutoff"])
     else:
         clashing_loss =  calc_clash_loss(predicted_structures, structural_loss_parameters["clash_pairs"], clash_cutoff=experiment_settings["loss"]["clashing_loss"]["clashing_cutoff"])
@@ -383,15 +536,10 @@ def compute_loss(predicted_images, images, segmentation_image, latent_mean, late
     loss_weights = compute_all_beta_schedule(epoch, experiment_settings["N_epochs"], experiment_settings["loss"])
 
     pixel_num = predicted_images.shape[-1]*predicted_images.shape[-2]
-    tracking_dict["correlation_loss"].append(rmsd.detach().cpu().numpy())
-    tracking_dict["kl_prior_latent"].append(KL_prior_latent.detach().cpu().numpy())
-    tracking_dict["kl_prior_segmentation_mean"].append(KL_prior_segmentation_means.detach().cpu().numpy())
-    tracking_dict["kl_prior_segmentation_std"].append(KL_prior_segmentation_stds.detach().cpu().numpy())
-    tracking_dict["kl_prior_segmentation_proportions"].append(KL_prior_segmentation_proportions.detach().cpu().numpy())
-    tracking_dict["l2_pen"].append(l2_pen.detach().cpu().numpy())
-    tracking_dict["continuity_loss"].append(continuity_loss.detach().cpu().numpy())
-    tracking_dict["clashing_loss"].append(clashing_loss.detach().cpu().numpy())
-    tracking_dict["clashing_loss"].append(clashing_loss.detach().cpu().numpy())
+    #The metrics stay on the device, see utils.MetricsAccumulator, so tracking them does not synchronize the device with the host.
+    tracking_dict["metrics"].update({"correlation_loss":rmsd, "kl_prior_latent":KL_prior_latent, "kl_prior_segmentation_mean":KL_prior_segmentation_means,
+                                     "kl_prior_segmentation_std":KL_prior_segmentation_stds, "kl_prior_segmentation_proportions":KL_prior_segmentation_proportions,
+                                     "l2_pen":l2_pen, "continuity_loss":continuity_loss, "clashing_loss":clashing_loss}, weight=predicted_images.shape[0])
     tracking_dict["betas"] = loss_weights
 
     loss = rmsd + loss_weights["KL_prior_latent"]*KL_prior_latent/pixel_num \
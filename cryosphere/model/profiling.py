@@ -0,0 +1,266 @@
+import os
+import json
+import torch
+import signal
+import logging
+import numpy as np
+from time import time
+from contextlib import nullcontext, contextmanager
+
+
+class StageTimer:
+    """
+    Opt-in instrumentation of the stages of a training step. Each stage is a named range, visible in torch.profiler traces, and optionally
+    timed: the device is synchronized before and after the stage so that its time is not attributed to the next one. The times are
+    accumulated over an epoch and logged in run.log. When disabled, a stage is a shared empty context and adds no synchronization.
+    """
+    def __init__(self, device, timers=False, ranges=False):
+        """
+        :param device: torch device on which we train.
+        :param timers: boolean, whether to time the stages. This synchronizes the device at every stage and slows down training.
+        :param ranges: boolean, whether to record the stages as named ranges for torch.profiler. Always True if timers is True.
+        """
+        self.device = torch.device(device)
+        self.timers = timers
+        self.ranges = ranges or timers
+        self.active_stage = None
+        self.empty_context = nullcontext()
+        self.reset()
+
+    def reset(self):
+        """
+        Sets the accumulated times to zero.
+        """
+        self.durations = {}
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def stage(self, name):
+        """
+        Context around a stage of the training step.
+        :param name: str, name of the stage.
+        :return: context manager.
+        """
+        if not self.ranges:
+            return self.empty_context
+
+        if not self.timers or self.active_stage is not None:
+            #A stage inside another one, such as a forward pass recomputed during the backward pass with activation checkpointing, is
+            #only recorded as a range. Its time is counted in the outer stage.
+            return torch.profiler.record_function(name)
+
+        return self.timed_stage(name)
+
+    @contextmanager
+    def timed_stage(self, name):
+        self.synchronize()
+        self.active_stage = name
+        start = time()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+
+            self.synchronize()
+        finally:
+            self.active_stage = None
+
+        self.add(name, time() - start)
+
+    def add(self, name, duration):
+        """
+        Adds a duration measured outside of the timer, such as the time spent waiting for the data loader.
+        :param name: str, name of the stage.
+        :param duration: float, duration in seconds.
+        """
+        self.durations[name] = self.durations.get(name, 0.) + duration
+
+    def log(self, epoch, N_steps):
+        """
+        Logs the mean time per step of each stage over the epoch, and its share of the time of all the stages, then resets the timer.
+        :param epoch: integer, epoch number.
+        :param N_steps: integer, number of steps performed during the epoch.
+        """
+        if self.timers:
+            total = sum(self.durations.values())
+            information_strings = [f"{name}: {1000 * duration / N_steps:.2f}ms ({100 * duration / total:.1f}%)" for name, duration in self.durations.items()]
+            logging.info(f"Epoch {epoch}, mean time per step of each stage: " + " || ".join(information_strings))
+
+        self.reset()
+
+
+class TraceWindow:
+    """
+    Captures windows of training steps with torch.profiler and exports them as chrome traces, to be opened in chrome://tracing or Perfetto.
+    A capture starts at a chosen step, or on demand while the training runs: when the process receives SIGUSR1, or when the trigger file
+    is created or touched in the results folder. Next to each trace, a json file gives the time of each captured step and the time spent
+    waiting for the data loader, to see whether a slowdown comes from reading the images.
+    """
+    def __init__(self, path_results, device, start_step=None, N_steps=5, rank=0, stage_timer=None, trigger_file="profile_trigger", check_every=10.):
+        """
+        :param path_results: str, folder in which the traces are written.
+        :param device: torch device on which we train.
+        :param start_step: integer, training step, counted from the start of the training, at which a capture starts. If None, only the
+                        captures requested on demand are made.
+        :param N_steps: integer, number of steps captured.
+        :param rank: integer, rank of the process, appended to the names of the files.
+        :param stage_timer: object of class StageTimer, whose stages are recorded as named ranges during the captures.
+        :param trigger_file: str, name of the trigger file in path_results. The file may contain the number of steps to capture. If None, the
+                        file is not watched.
+        :param check_every: float, minimum time in seconds between two checks of the trigger file.
+        """
+        self.path_results = path_results
+        self.device = torch.device(device)
+        self.start_step = start_step
+        self.N_steps = N_steps
+        self.rank = rank
+        self.stage_timer = stage_timer
+        self.trigger_path = os.path.join(path_results, trigger_file) if trigger_file is not None else None
+        self.check_every = check_every
+        self.step_num = 0
+        self.profiler = None
+        self.first_step = None
+        self.capture_steps = None
+        self.requested_steps = None
+        self.step_records = []
+        self.last_check = time()
+        self.last_step_end = time()
+        #A trigger file left by a previous run does not start a capture, only a file created or touched during this run does.
+        self.trigger_mtime = self.trigger_file_mtime()
+        if start_step == 0:
+            self.start(N_steps)
+
+    def install_signal_handler(self):
+        """
+        Starts a capture at the next step when the process receives SIGUSR1. Must be called from the main thread.
+        """
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.request())
+
+    def request(self, N_steps=None):
+        """
+        Requests a capture starting at the next step. Safe to call from a signal handler.
+        :param N_steps: integer, number of steps to capture. If None, N_steps of the constructor is used.
+        """
+        self.requested_steps = N_steps or self.N_steps
+
+    def trigger_file_mtime(self):
+        if self.trigger_path is None:
+            return None
+
+        try:
+            return os.stat(self.trigger_path).st_mtime
+        except OSError:
+            return None
+
+    def check_trigger_file(self):
+        """
+        Requests a capture if the trigger file was created or touched since the last check. The file system is queried at most every check_every seconds.
+        """
+        if self.trigger_path is None or time() - self.last_check < self.check_every:
+            return
+
+        self.last_check = time()
+        mtime = self.trigger_file_mtime()
+        if mtime is None or mtime == self.trigger_mtime:
+            return
+
+        self.trigger_mtime = mtime
+        N_steps = None
+        try:
+            with open(self.trigger_path, "r") as file:
+                N_steps = int(file.read().strip())
+        except (OSError, ValueError):
+            pass
+
+        logging.info(f"Found the trigger file {self.trigger_path}, capturing the next steps.")
+        self.request(N_steps)
+
+    def start(self, N_steps):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.start()
+        self.first_step = self.step_num
+        self.capture_steps = N_steps
+        self.step_records = []
+        if self.stage_timer is not None:
+            self.stage_ranges = self.stage_timer.ranges
+            self.stage_timer.ranges = True
+
+    def stop(self):
+        self.profiler.stop()
+        if self.stage_timer is not None:
+            self.stage_timer.ranges = self.stage_ranges
+
+        file_name = f"rank{self.rank}_steps_{self.first_step}_{self.step_num - 1}"
+        trace_path = os.path.join(self.path_results, f"trace_{file_name}.json")
+        self.profiler.export_chrome_trace(trace_path)
+        self.profiler = None
+        durations = np.array([record["duration"] for record in self.step_records])
+        data_waits = np.array([record["data_wait"] for record in self.step_records if record["data_wait"] is not None])
+        stalls = {"steps": self.step_records, "mean_step_duration": float(np.mean(durations)) if len(durations) else None}
+        if len(data_waits):
+            stalls.update({"mean_data_wait": float(np.mean(data_waits)), "max_data_wait": float(np.max(data_waits)),
+                           "data_wait_share": float(np.sum(data_waits)/np.sum(durations))})
+
+        stalls_path = os.path.join(self.path_results, f"data_stalls_{file_name}.json")
+        with open(stalls_path, "w") as file:
+            json.dump(stalls, file, indent=4)
+
+        logging.info(f"Trace of the training steps {self.first_step} to {self.step_num - 1} written to {trace_path}, time waiting for the data written to {stalls_path}.")
+
+    def close(self):
+        """
+        Stops the capture if the training ends before the end of the window.
+        """
+        if self.profiler is not None:
+            self.stop()
+
+    def step(self, data_wait=None):
+        """
+        Called at the end of each training step. Records the step if it is captured, then starts and stops the captures.
+        :param data_wait: float, time in seconds spent waiting for the data loader during this step, see dataset.DevicePrefetcher.last_wait.
+        """
+        if self.profiler is not None:
+            #The device is synchronized so that the duration of each captured step is accurate.
+            if self.device.type == "cuda":
+                torch.cuda.synchronize(self.device)
+
+            self.step_records.append({"step": self.step_num, "duration": time() - self.last_step_end, "data_wait": data_wait})
+
+        self.last_step_end = time()
+        self.step_num += 1
+        if self.profiler is not None and self.step_num - self.first_step >= self.capture_steps:
+            self.stop()
+
+        self.check_trigger_file()
+        if self.profiler is None and self.step_num == self.start_step:
+            self.start(self.N_steps)
+        elif self.profiler is None and self.requested_steps is not None:
+            self.start(self.requested_steps)
+            self.requested_steps = None
+
+
+def forward_signal(signum, pids, ready=None):
+    """
+    Forwards a signal received by this process to other processes, such as SIGUSR1 from the process launching the training to the training processes.
+    :param signum: signal number.
+    :param pids: list of integers, ids of the processes.
+    :param ready: sequence of integers of the same length as pids, typically a shared array. The signal is only forwarded to the processes
+                whose value is not 0, that is, the processes that reported they handle the signal. If None, it is forwarded to all of them.
+    """
+    def handler(received_signum, frame):
+        for i, pid in enumerate(pids):
+            if ready is not None and not ready[i]:
+                continue
+
+            try:
+                os.kill(pid, received_signum)
+            except OSError:
+                pass
+
+    signal.signal(signum, handler)
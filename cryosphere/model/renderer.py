@@ -3,38 +3,97 @@ import einops
 import numpy as np
 from time import time
 import matplotlib.pyplot as plt
+from cryosphere.model.fourier import primal_to_fourier2d, fourier2d_to_primal, apply_filter
 
 
-def primal_to_fourier2d(images):
+class ChunkedProjection(torch.autograd.Function):
     """
-    Computes the fourier transform of the images.
-    images: torch.tensor(batch_size, N_pix, N_pix)
-    return fourier transform of the images
-    """
-    r = torch.fft.ifftshift(images, dim=(-2, -1))
-    fourier_images = torch.fft.fftshift(torch.fft.fft2(r, dim=(-2, -1), s=(r.shape[-2], r.shape[-1])), dim=(-2, -1))
-    return fourier_images
-
-def fourier2d_to_primal(fourier_images):
+    Projection of a GMM computed by chunks of atoms. The (batch_size, chunk_size, N_pix) kernels are recomputed in the backward pass instead of being stored,
+    so the memory used no longer grows with the number of atoms.
     """
-    Computes the inverse fourier transform
-    fourier_images: torch.tensor(batch_size, N_pix, N_pix)
-    return fourier transform of the images
-    """
-    f = torch.fft.ifftshift(fourier_images, dim=(-2, -1))
-    r = torch.fft.fftshift(torch.fft.ifft2(f, dim=(-2, -1), s=(f.shape[-2], f.shape[-1])),dim=(-2, -1)).real
-    return r
-
-
-def project(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid):
+    @staticmethod
+    def forward(ctx, Gauss_mean, Gauss_sigmas, Gauss_amplitudes, line_coords, chunk_size):
+        """
+        Gauss_mean: torch.tensor(batch_size, N_atoms, 3) of structures.
+        Gauss_sigmas: torch.tensor(N_atoms, 1) of std for the Gaussian kernel.
+        Gauss_amplitudes: torch.tensor(N_atoms, 1) of coefficients used to scale the Gausian kernels.
+        line_coords: torch.tensor(N_pix) coordinates of the pixels along one axis.
+        chunk_size: integer, number of atoms projected at once.
+        return images: torch.tensor(batch_size, N_pix, N_pix)
+        """
+        ctx.save_for_backward(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, line_coords)
+        ctx.chunk_size = chunk_size
+        #The images are accumulated in place, in the precision of the inputs.
+        with torch.autocast(Gauss_mean.device.type, enabled=False):
+            return ChunkedProjection.project_chunks(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, line_coords, chunk_size)
+
+    @staticmethod
+    def project_chunks(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, line_coords, chunk_size):
+        """
+        Projects the atoms chunk by chunk, see forward.
+        """
+        images = torch.zeros((Gauss_mean.shape[0], line_coords.shape[0], line_coords.shape[0]), dtype=Gauss_mean.dtype, device=Gauss_mean.device)
+        for start in range(0, Gauss_mean.shape[1], chunk_size):
+            end = start + chunk_size
+            sigmas = 2*Gauss_sigmas[start:end]**2
+            proj_x = torch.exp(-(Gauss_mean[:, start:end, None, 0] - line_coords[None, None, :])**2/sigmas[None, :, None, 0])*Gauss_amplitudes[None, start:end, :]
+            proj_y = torch.exp(-(Gauss_mean[:, start:end, None, 1] - line_coords[None, None, :])**2/sigmas[None, :, None, 0])
+            images.baddbmm_(proj_y.transpose(1, 2), proj_x)
+
+        return images
+
+    @staticmethod
+    def backward(ctx, grad_images):
+        """
+        grad_images: torch.tensor(batch_size, N_pix, N_pix) gradient of the loss with respect to the images.
+        return the gradients with respect to the means, sigmas and amplitudes of the Gaussians.
+        """
+        Gauss_mean, Gauss_sigmas, Gauss_amplitudes, line_coords = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        grad_mean = grad_sigmas = grad_amplitudes = None
+        if ctx.needs_input_grad[0]:
+            grad_mean = torch.zeros_like(Gauss_mean)
+        if ctx.needs_input_grad[1]:
+            grad_sigmas = torch.zeros_like(Gauss_sigmas)
+        if ctx.needs_input_grad[2]:
+            grad_amplitudes = torch.zeros_like(Gauss_amplitudes)
+
+        for start in range(0, Gauss_mean.shape[1], chunk_size):
+            end = start + chunk_size
+            sigmas = 2*Gauss_sigmas[start:end]**2
+            amplitudes = Gauss_amplitudes[None, start:end, :]
+            diff_x = Gauss_mean[:, start:end, None, 0] - line_coords[None, None, :]
+            diff_y = Gauss_mean[:, start:end, None, 1] - line_coords[None, None, :]
+            kernel_x = torch.exp(-diff_x**2/sigmas[None, :, None, 0])
+            kernel_y = torch.exp(-diff_y**2/sigmas[None, :, None, 0])
+            #images[b, q, p] is the sum over the atoms of amplitudes[a]*kernel_y[b, a, q]*kernel_x[b, a, p].
+            grad_x = torch.bmm(kernel_y, grad_images)*kernel_x
+            grad_y = torch.bmm(kernel_x, grad_images.transpose(1, 2))*kernel_y
+            if grad_mean is not None:
+                grad_mean[:, start:end, 0] = -2*amplitudes[..., 0]*torch.sum(grad_x*diff_x, dim=-1)/sigmas[None, :, 0]
+                grad_mean[:, start:end, 1] = -2*amplitudes[..., 0]*torch.sum(grad_y*diff_y, dim=-1)/sigmas[None, :, 0]
+            if grad_sigmas is not None:
+                grad_sigmas[start:end, 0] = Gauss_amplitudes[start:end, 0]*torch.sum(torch.sum(grad_x*diff_x**2, dim=-1) + torch.sum(grad_y*diff_y**2, dim=-1), dim=0)/Gauss_sigmas[start:end, 0]**3
+            if grad_amplitudes is not None:
+                grad_amplitudes[start:end, 0] = torch.sum(grad_x, dim=(0, -1))
+
+        return grad_mean, grad_sigmas, grad_amplitudes, None, None
+
+
+def project(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid, chunk_size=None):
     """
     Project a volumes represented by a GMM into a 2D images, by integrating along the z axis
     Gauss_mean: torch.tensor(batch_size, N_atoms, 3) of structures.
     Gauss_sigmas: torch.tensor(N_atoms, 1) of std for the Gaussian kernel.
     Gauss_amplitudes: torch.tensor(N_atoms, 1) of coefficients used to scale the Gausian kernels.
     grid: grid object
+    chunk_size: integer, if not None, the atoms are projected by chunks of chunk_size atoms and the intermediate kernels are recomputed
+                in the backward pass instead of being stored, see ChunkedProjection.
     return images: torch.tensor(batch_size, N_pix, N_pix)
     """
+    if chunk_size is not None:
+        return ChunkedProjection.apply(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid.line_coords, chunk_size)
+
     sigmas = 2*Gauss_sigmas**2
     sqrt_amp = torch.sqrt(Gauss_amplitudes)
     proj_x = torch.exp(-(Gauss_mean[:, :, None, 0] - grid.line_coords[None, None, :])**2/sigmas[None, :, None,  0])*sqrt_amp[None, :, :]
@@ -42,6 +101,28 @@ def project(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid):
     images = torch.einsum("b a p, b a q -> b q p", proj_x, proj_y)
     return images
 
+def project_fourier(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid):
+    """
+    Computes directly the fourier transform of the projection of a GMM, using the closed form fourier transform of the Gaussians. 
+    The result approximates primal_to_fourier2d(project(...)), up to the aliasing of the Gaussians narrower than a pixel and of the Gaussians close to the edges.
+    Gauss_mean: torch.tensor(batch_size, N_atoms, 3) of structures.
+    Gauss_sigmas: torch.tensor(N_atoms, 1) of std for the Gaussian kernel.
+    Gauss_amplitudes: torch.tensor(N_atoms, 1) of coefficients used to scale the Gausian kernels.
+    grid: grid object
+    return images: torch.tensor(batch_size, N_pix, N_pix) complex fourier transforms of the images, in the centered order of primal_to_fourier2d.
+    """
+    N_pix = grid.line_coords.shape[0]
+    apix = grid.voxel_size
+    freqs = torch.fft.fftshift(torch.fft.fftfreq(N_pix, apix, device=Gauss_mean.device))
+    #The phases are relative to the center of the image, which is the origin of primal_to_fourier2d.
+    center = grid.line_coords[N_pix//2]
+    #The fourier transform of exp(-x**2/(2*sigma**2)) sampled every apix is sqrt(2*pi)*sigma/apix*exp(-2*pi**2*sigma**2*k**2).
+    envelope = torch.sqrt(2*torch.pi*Gauss_amplitudes)*Gauss_sigmas/apix*torch.exp(-2*torch.pi**2*Gauss_sigmas**2*freqs[None, :]**2)
+    proj_x = torch.exp(-2j*torch.pi*(Gauss_mean[:, :, None, 0] - center)*freqs[None, None, :])*envelope[None, :, :]
+    proj_y = torch.exp(-2j*torch.pi*(Gauss_mean[:, :, None, 1] - center)*freqs[None, None, :])*envelope[None, :, :]
+    images = torch.einsum("b a p, b a q -> b q p", proj_x, proj_y)
+    return images
+
 def structure_to_volume(Gauss_means, Gauss_sigmas, Gauss_amplitudes, grid, device):
     """
     Turn a structure into a volume using the GMM representation.
@@ -92,12 +173,21 @@ def apply_ctf(images, ctf, indexes):
     indexes: torch.tensor(batch_size, type=int), indexes of the images, to compute the ctf.
     return torch.tensor(N_batch, N_pix, N_pix) of ctf corrupted images
     """
-    fourier_images = primal_to_fourier2d(images)
-    fourier_images *= -ctf.compute_ctf(indexes)
-    ctf_corrupted = fourier2d_to_primal(fourier_images)
+    ctf_corrupted = apply_filter(images, -ctf.compute_ctf(indexes, half=True))
     return ctf_corrupted
 
 
+def apply_ctf_fourier(fourier_images, ctf, indexes):
+    """
+    Apply ctf to images already in fourier space, see apply_ctf.
+    fourier_images: torch.tensor(batch_size, N_pix, N_pix) complex fourier transforms of the images, in the centered order of primal_to_fourier2d.
+    ctf: CTF object
+    indexes: torch.tensor(batch_size, type=int), indexes of the images, to compute the ctf.
+    return torch.tensor(N_batch, N_pix, N_pix) of fourier transforms of the ctf corrupted images
+    """
+    return -fourier_images*ctf.compute_ctf(indexes)
+
+
 
 
 
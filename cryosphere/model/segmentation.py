@@ -59,6 +59,25 @@ class Segmentation(torch.nn.Module):
 		self.device = device
 		self.elu = torch.nn.ELU()
 		self.N_residues = len(self.residues_chain)
+		self.masks = {}
+		for part, part_config in segmentation_config.items():
+			#The masks are computed once, and the indexes of the residues of each part are kept on the device, so that the deformation
+			#of the structure does not convert them at every step.
+			self.masks[part] = self.compute_mask(part_config)
+			self.register_buffer(f"indexes_{part}", torch.tensor(np.nonzero(self.masks[part])[0], dtype=torch.long, device=device), persistent=False)
+			self.register_buffer(f"residues_{part}", self.compute_residues(part_config), persistent=False)
+
+		#To sample the segmentations of all the parts at once, the residues and the segments of the parts are padded to the largest part.
+		N_residues_parts = [getattr(self, f"residues_{part}").shape[0] for part in segmentation_config]
+		N_segments_parts = [part_config["N_segm"] for part_config in segmentation_config.values()]
+		padded_residues = torch.zeros((len(segmentation_config), max(N_residues_parts)), dtype=torch.float32, device=device)
+		segments_padding = torch.ones((len(segmentation_config), max(N_segments_parts)), dtype=torch.bool, device=device)
+		for i, part in enumerate(segmentation_config):
+			padded_residues[i, :N_residues_parts[i]] = getattr(self, f"residues_{part}")[:, 0]
+			segments_padding[i, :N_segments_parts[i]] = False
+
+		self.register_buffer("padded_residues", padded_residues, persistent=False)
+		self.register_buffer("segments_padding", segments_padding, persistent=False)
 
 		for part, part_config in segmentation_config.items():
 			N_segments = part_config["N_segm"]
@@ -151,36 +170,57 @@ class Segmentation(torch.nn.Module):
 						"std":part_config["segmentation_prior"][f"{type_value}_stds"]}
 
 
-	def sample_segmentation(self, N_batch, part_config, part):
+	def compute_mask(self, part_config):
 		"""
-		Samples a segmantion
-		:param N_batch: integer: size of the batch.
-		:param N_segments: integer, number of segments
+		Computes the mask of the residues to which the segmentation of a part is applied.
 		:param part_config: dictionnary, containing the parameters of the GMM for segmenting
-		:param part: part of the protein we want to sample a segmentation for.
-		:return: dictionnary of torch.tensor(N_batch, N_residues, N_segments) values of the segmentation, np.array of 0 and 1, 
-				mask to get the residues to which we apply the segmentation, in the frame of the total protein, not of the chain.
+		:return: np.array of 0 and 1, mask to get the residues to which we apply the segmentation, in the frame of the total protein, not of the chain.
+		"""
+		if part_config.get("all_protein", False):
+			return np.ones(self.N_residues, dtype=np.float32)
+
+		chain_id = part_config["chain"]
+		#Be careful: the start and end residues are included and the residue numbering starts at 0.
+		mask = np.zeros(self.N_residues, dtype=np.float32)
+		tmp_array = mask[self.residues_chain == chain_id]
+		tmp_array[[i for i in range(part_config["start_res"], part_config["end_res"]+1)]] = 1
+		mask[self.residues_chain == chain_id] = tmp_array
+		return mask
+
+	def compute_residues(self, part_config):
+		"""
+		Computes the indexes of the residues of a part, in the frame of its chain, used as the coordinates of the GMM segmentation.
+		:param part_config: dictionnary, containing the parameters of the GMM for segmenting
+		:return: torch.tensor(N_residues_part, 1) of indexes of the residues.
 		"""
-		N_segments = part_config["N_segm"]
 		if part_config.get("all_protein", False):
 			residues_chain = self.residues_indexes
-			mask = np.ones(self.N_residues, dtype=np.float32)
 			start_res = 0
 			end_res = len(residues_chain) - 1
 		else:
 			chain_id = part_config["chain"]
 			#Be careful: the start and end residues are included and the residue numbering starts at 0.
 			residues_chain = self.residues_indexes[self.residues_chain == chain_id]
-			mask = np.zeros(self.N_residues, dtype=np.float32)
-			tmp_array = mask[self.residues_chain == chain_id]
-			tmp_array[[i for i in range(part_config["start_res"], part_config["end_res"]+1)]] = 1
-			mask[self.residues_chain == chain_id] = tmp_array
 			start_res = part_config["start_res"]
 			end_res = part_config["end_res"]
 
 		#In residues_chain, we have the indexes of the relevant residues in the frame of the total protein. We want to find their indexes in the frame of the chain, so we 
 		# minus the first indexes of that chain
-		residues = residues_chain[[i for i in range(start_res, end_res+1)]] - torch.min(residues_chain)
+		return residues_chain[start_res:end_res+1] - torch.min(residues_chain)
+
+	def sample_segmentation(self, N_batch, part_config, part):
+		"""
+		Samples a segmantion
+		:param N_batch: integer: size of the batch.
+		:param N_segments: integer, number of segments
+		:param part_config: dictionnary, containing the parameters of the GMM for segmenting
+		:param part: part of the protein we want to sample a segmentation for.
+		:return: dictionnary of torch.tensor(N_batch, N_residues, N_segments) values of the segmentation, np.array of 0 and 1, 
+				mask to get the residues to which we apply the segmentation, in the frame of the total protein, not of the chain, and
+				torch.tensor(N_residues_part) of the indexes of these residues, on the device.
+		"""
+		N_segments = part_config["N_segm"]
+		residues = getattr(self, f"residues_{part}")
 		#We sample the proportions of the GMM
 		cluster_proportions = torch.randn((N_batch, N_segments),
 		                                  device=self.device) * self.segments_proportions_stds[part] + self.segments_proportions_means[part] 
@@ -194,7 +234,18 @@ class Segmentation(torch.nn.Module):
 		log_num = -0.5*(residues[None, :, :] - cluster_means[:, None, :])**2/cluster_std[:, None, :]**2 + \
 		      torch.log(proportions[:, None, :])
 
-		return {"segmentation":torch.softmax(log_num / self.tau_segmentation, dim=-1), "mask":mask}
+		return {"segmentation":torch.softmax(log_num / self.tau_segmentation, dim=-1), "mask":self.masks[part], "indexes":getattr(self, f"indexes_{part}")}
+
+	def stack_parameters(self, parameters, padding_value):
+		"""
+		Stacks the parameters of the segmentations of all the parts, padded to the largest number of segments.
+		:param parameters: torch.nn.ParameterDict containing, for each part, the parameters of its segments.
+		:param padding_value: float, value of the parameters of the padded segments.
+		:return: torch.tensor(N_parts, N_segments_max)
+		"""
+		N_segments = self.segments_padding.shape[1]
+		return torch.stack([torch.nn.functional.pad(parameters[part].reshape(-1), (0, N_segments - parameters[part].numel()), value=padding_value) 
+							for part in self.segmentation_config])
 
 	def sample_segments(self, N_batch):
 		"""
@@ -203,9 +254,29 @@ class Segmentation(torch.nn.Module):
 		:return: all_segmentations, dictionnary containing, for each part we want to segment, the values of the stochastic matrix and the residue indexes it is applied to.
 		"""
 		all_segmentations = {}
-		for part, part_config in self.segmentation_config.items():
-			segmentation = self.sample_segmentation(N_batch, part_config, part)
-			all_segmentations[part] = segmentation
+		if len(self.segmentation_config) == 1:
+			for part, part_config in self.segmentation_config.items():
+				all_segmentations[part] = self.sample_segmentation(N_batch, part_config, part)
+
+			return all_segmentations
+
+		#Otherwise, the parts are sampled together, padded to the largest number of segments and of residues.
+		parts = list(self.segmentation_config.keys())
+		N_segments = self.segments_padding.shape[1]
+		stack = self.stack_parameters
+		cluster_proportions = torch.randn((N_batch, len(parts), N_segments), device=self.device) * stack(self.segments_proportions_stds, 0) + \
+								stack(self.segments_proportions_means, 0)
+		cluster_means = torch.randn((N_batch, len(parts), N_segments), device=self.device) * stack(self.segments_means_stds, 0) + stack(self.segments_means_means, 0)
+		cluster_std = self.elu(torch.randn((N_batch, len(parts), N_segments), device=self.device)*stack(self.segments_stds_stds, 0) + stack(self.segments_stds_means, 1)) + 1
+		#The padded segments get a proportion of 0.
+		log_proportions = torch.log_softmax(cluster_proportions.masked_fill(self.segments_padding, -torch.inf), dim=-1)
+		log_num = -0.5*(self.padded_residues[None, :, :, None] - cluster_means[:, :, None, :])**2/cluster_std[:, :, None, :]**2 + \
+		      log_proportions[:, :, None, :]
+
+		segmentations = torch.softmax(log_num / self.tau_segmentation, dim=-1)
+		for i, (part, part_config) in enumerate(self.segmentation_config.items()):
+			all_segmentations[part] = {"segmentation":segmentations[:, i, :getattr(self, f"residues_{part}").shape[0], :part_config["N_segm"]], 
+										"mask":self.masks[part], "indexes":getattr(self, f"indexes_{part}")}
 
 		return all_segmentations
 
@@ -4,10 +4,12 @@ import yaml
 import wandb
 import torch
 import shutil
+import hashlib
 import einops
 import random
 import ntpath
 import logging
+import resource
 import mrcfile
 import warnings
 import starfile
@@ -16,6 +18,7 @@ file_dir = os.path.dirname(__file__)
 sys.path.append(file_dir)
 import pandas as pd
 from tqdm import tqdm
+import torch.utils.checkpoint
 import torch.nn.functional as F
 from scipy.spatial import distance
 from cryosphere.model.vae import VAE
@@ -26,10 +29,11 @@ from biotite.structure.io.pdb import PDBFile
 from cryosphere.model.polymer import Polymer
 from torch.distributed import init_process_group
 from cryosphere.model.dataset import ImageDataSet
+from cryosphere.model.fourier import primal_to_fourier2d, fourier2d_to_primal, apply_filter, centered_to_half
 from cryosphere.model.gmm import Gaussian, EMAN2Grid
 from cryosphere.model.segmentation import Segmentation
 #from pytorch3d.transforms import quaternion_to_axis_angle, axis_angle_to_matrix, axis_angle_to_quaternion, quaternion_apply
-from cryosphere.model.loss import compute_loss, find_range_cutoff_pairs, remove_duplicate_pairs, find_continuous_pairs, calc_dist_by_pair_indices
+from cryosphere.model.loss import compute_loss, find_range_cutoff_pairs, remove_duplicate_pairs, find_continuous_pairs, calc_dist_by_pair_indices, ClashNeighborList
 import roma
 from roma import unitquat_to_rotvec, rotvec_to_rotmat, rotvec_to_unitquat
 
@@ -47,26 +51,6 @@ def ddp_setup(rank: int, world_size: int):
    init_process_group(backend="nccl", rank=rank, world_size=world_size)
 
 
-def primal_to_fourier2d(images):
-    """
-    Computes the fourier transform of the images.
-    images: torch.tensor(batch_size, N_pix, N_pix)
-    return: torch.tensor(batch_size, N_pix, N_pix) fourier transform of the images
-    """
-    r = torch.fft.ifftshift(images, dim=(-2, -1))
-    fourier_images = torch.fft.fftshift(torch.fft.fft2(r, dim=(-2, -1), s=(r.shape[-2], r.shape[-1])), dim=(-2, -1))
-    return fourier_images
-
-def fourier2d_to_primal(fourier_images):
-    """
-    Computes the inverse fourier transform
-    fourier_images: torch.tensor(batch_size, N_pix, N_pix)
-    return: torch.tensor(batch_size, N_pix, N_pix) images in real space
-    """
-    f = torch.fft.ifftshift(fourier_images, dim=(-2, -1))
-    r = torch.fft.fftshift(torch.fft.ifft2(f, dim=(-2, -1), s=(f.shape[-2], f.shape[-1])),dim=(-2, -1)).real
-    return r
-
 class Mask(torch.nn.Module):
 
     def __init__(self, im_size, rad, device):
@@ -101,12 +85,10 @@ def low_pass_images(images, lp_mask2d):
     """
     Low pass filtering of the images.
     images: torch.tensor(batch_size, N_pix, N_pix)
-    lp_mask2d: torch.tensor(N_pix, N_pix)
+    lp_mask2d: torch.tensor(N_pix, N_pix) with the zero frequency at the center, only its half plane is used.
     return: torch.tensor(batch_size, N_pix, N_pix) low pass filtered images
     """
-    f_images = primal_to_fourier2d(images)
-    f_images = f_images * lp_mask2d
-    images = fourier2d_to_primal(f_images).real
+    images = apply_filter(images, centered_to_half(lp_mask2d))
     return images
 
 
@@ -129,6 +111,39 @@ def low_pass_mask2d(shape, apix=1., bandwidth=2):
     return mask
 
 
+def load_clash_pairs(base_structure_path, coord_arr, connect_pairs, min_cutoff, max_cutoff):
+    """
+    Finds the pairs of residues used by the light version of the clashing loss, see loss.find_range_cutoff_pairs, without the pairs used by
+    the continuity loss. The pairs are cached in a file next to the base structure, keyed by the coordinates, the continuity pairs and the cutoffs.
+    :param base_structure_path: str, path to the pdb file of the base structure.
+    :param coord_arr: np.array(N_residues, 3) coordinates of each residue.
+    :param connect_pairs: np.array(N_pairs, 2) pairs of residues used by the continuity loss.
+    :param min_cutoff: float, minimum cutoff to consider the pair for the clashing loss
+    :param max_cutoff: float, maximum cutoff to consider the pair for the clashing loss
+    :return: np.array(N_pairs, 2) pairs of residues considered for the clashing loss
+    """
+    key = hashlib.sha1()
+    for value in [np.ascontiguousarray(coord_arr, dtype=np.float64), np.ascontiguousarray(connect_pairs, dtype=np.int64), np.array([min_cutoff, max_cutoff], dtype=np.float64)]:
+        key.update(value.tobytes())
+
+    pairs_file = f"{os.path.splitext(base_structure_path)[0]}_clash_pairs_{key.hexdigest()[:16]}.npy"
+    if os.path.exists(pairs_file):
+        print("Using the clashing pairs from", pairs_file)
+        return np.load(pairs_file)
+
+    clash_pairs = find_range_cutoff_pairs(coord_arr, min_cutoff, max_cutoff)
+    clash_pairs = remove_duplicate_pairs(clash_pairs, connect_pairs)
+    try:
+        #The file is written atomically since several processes may compute the pairs at the same time.
+        tmp_pairs_file = f"{pairs_file}.{os.getpid()}.tmp.npy"
+        np.save(tmp_pairs_file, clash_pairs)
+        os.replace(tmp_pairs_file, pairs_file)
+    except OSError as error:
+        print("Could not save the clashing pairs to", pairs_file, ":", error)
+
+    return clash_pairs
+
+
 def set_wandb(experiment_settings):
     if experiment_settings["wandb"] == True:
         wandb.login()
@@ -217,7 +232,7 @@ def parse_yaml(path, gpu_id, analyze=False):
     Npix_downsize = image_settings["Npix_downsize"]
     amortized = experiment_settings["amortized"]
     apix_downsize = Npix * apix /Npix_downsize
-    image_translator = SpatialGridTranslate(D=Npix_downsize, device=device)
+    image_translator = SpatialGridTranslate(D=Npix_downsize, device=device, mode=experiment_settings.get("translation_mode", "real"))
 
     encoder = MLP(Npix_downsize**2,
                   experiment_settings["latent_dimension"] * 2,
@@ -276,8 +291,14 @@ def parse_yaml(path, gpu_id, analyze=False):
 
 
     cs_star_config = experiment_settings["cs_star_file"]
-    ctf_experiment = CTF.create_ctf(cs_star_config, apix = apix_downsize, side_shape=Npix_downsize , device=device)
-    dataset = ImageDataSet(apix, Npix, cs_star_config, particles_path, down_side_shape=Npix_downsize, rad_mask=experiment_settings.get("input_mask_radius"))
+    ctf_experiment = CTF.create_ctf(cs_star_config, apix = apix_downsize, side_shape=Npix_downsize , device=device, cache_size=experiment_settings.get("ctf_cache_size", 0))
+    cache_path = None
+    if experiment_settings.get("cache_path"):
+        cache_path = os.path.join(folder_path, experiment_settings["cache_path"])
+
+    dataset = ImageDataSet(apix, Npix, cs_star_config, particles_path, down_side_shape=Npix_downsize, rad_mask=experiment_settings.get("input_mask_radius"), 
+                           cache_path=cache_path, cache_dtype=experiment_settings.get("cache_dtype", "float32"), num_workers=experiment_settings["num_workers"],
+                           max_open_files=experiment_settings.get("max_open_files", 64), raw_images=experiment_settings.get("gpu_preprocessing", False) and not analyze)
 
     scheduler = None
     if "scheduler" in experiment_settings:
@@ -299,16 +320,22 @@ def parse_yaml(path, gpu_id, analyze=False):
     dists = calc_dist_by_pair_indices(base_structure.coord, connect_pairs)
     dists = torch.tensor(dists, device=device, dtype=torch.float32)
     assert "full_clashing_loss" in experiment_settings["loss"]["clashing_loss"], "Please indicate whether you want to use the full clashing loss or its light version."
+    clash_neighbor_list = None
     if experiment_settings["loss"]["clashing_loss"]["full_clashing_loss"]:
         clash_pairs = None
+        neighbor_list_settings = experiment_settings["loss"]["clashing_loss"].get("neighbor_list")
+        if neighbor_list_settings:
+            clash_neighbor_list = ClashNeighborList(experiment_settings["loss"]["clashing_loss"]["clashing_cutoff"], skin=neighbor_list_settings.get("skin", 2.0),
+                                                    rebuild_every=neighbor_list_settings.get("rebuild_every", 10))
     else:
-        clash_pairs = find_range_cutoff_pairs(base_structure.coord, experiment_settings["loss"]["clashing_loss"]["min_clashing_cutoff_pairs"],experiment_settings["loss"]["clashing_loss"]["max_clashing_cutoff_pairs"])
-        clash_pairs = remove_duplicate_pairs(clash_pairs, connect_pairs)
+        clash_pairs = load_clash_pairs(base_structure_path, base_structure.coord, connect_pairs, experiment_settings["loss"]["clashing_loss"]["min_clashing_cutoff_pairs"],
+                                       experiment_settings["loss"]["clashing_loss"]["max_clashing_cutoff_pairs"])
         clash_pairs = torch.tensor(clash_pairs, device=device, dtype=torch.long)
 
     connect_pairs = torch.tensor(connect_pairs, device=device, dtype=torch.long)
     structural_loss_parameters = {"connect_pairs":connect_pairs, 
                        "clash_pairs":clash_pairs, 
+                       "clash_neighbor_list":clash_neighbor_list,
                        "connect_distances":dists}
 
 
@@ -319,6 +346,7 @@ def parse_yaml(path, gpu_id, analyze=False):
         logging.info(f"Running cryoSPHERE with {torch.cuda.device_count()} gpus.")
     logging.info(f"Find checkpoints at {path_results}")
     logging.info(f"Using particles: {particles_path}. Using starfile: {cs_star_config['file']}.")
+    logging.info(f"Using cached preprocessed images: {dataset.cache_file}.")
     logging.info(f"Running the amortized version of cryoSPHERE: {amortized}. Training for {N_epochs} epochs.")
     logging.info(f"Image size: {Npix}. Pixel size: {apix}. Running cryoSPHERE on downsampled images of size: {Npix_downsize} with pixel size {apix_downsize}.")
     logging.info(f"""Low pass filtering bandwidth: {experiment_settings.get("lp_bandwidth")}. Input images mask radius: {experiment_settings.get('input_mask_radius')}. Correlation loss radius: {experiment_settings.get("loss_mask_radius")}.""")
@@ -344,11 +372,22 @@ def parse_yaml(path, gpu_id, analyze=False):
 
 class SpatialGridTranslate(torch.nn.Module):
     """
-    Class that defines the way we translate the images in real space.
+    Class that defines the way we translate the images, either in real space with bilinear interpolation or in fourier space with a phase shift.
     """
-    def __init__(self, D, device=None) -> None:
+    def __init__(self, D, device=None, mode="real") -> None:
+        """
+        :param D: integer, number of pixels on each side of the images.
+        :param device: torch device on which the coordinates are stored.
+        :param mode: str, "real" to translate the images by interpolation in real space, "fourier" to translate them by multiplying their
+                    fourier transform by a phase shift. The fourier translation is exact for any translation and can be fused with the low pass filtering.
+        """
         super().__init__()
+        assert mode in ["real", "fourier"], "The translation mode must be 'real' or 'fourier'."
         self.D = D
+        self.mode = mode
+        #Frequencies in cycles per pixel, in the same centered order as primal_to_fourier2d.
+        freqs = torch.fft.fftshift(torch.fft.fftfreq(self.D, device=device))
+        self.register_buffer("freqs", freqs)
         # yapf: disable
         #Coord is of shape (N_coord, 2). The coordinates go from -1 to 1, representing not actual physical coordinates but rather proportion of a half image.
         coords = torch.stack(torch.meshgrid([
@@ -380,6 +419,10 @@ class SpatialGridTranslate(torch.nn.Module):
         B, NY, NX = images.shape
         assert self.D == NY == NX
         assert images.shape[0] == trans.shape[0]
+        if self.mode == "fourier":
+            fourier_images = primal_to_fourier2d(images)[:, None]*self.phase_shift(trans)
+            return fourier2d_to_primal(fourier_images)[:, 0, :, :]
+
         #We translate the coordinates not in terms of absolute translations but in terms of fractions of a half image, to be consistent with the way coord is defined.
         grid = einops.rearrange(self.coords, "N C2 -> 1 1 N C2") - \
             einops.rearrange(trans, "B T C2 -> B T 1 C2") * 2 / self.D
@@ -394,23 +437,245 @@ class SpatialGridTranslate(torch.nn.Module):
         sampled = einops.rearrange(sampled, "B 1 T (NY NX) -> B T NY NX", NX=NX, NY=NY)
         return sampled[:, 0, :, :]
 
+    def phase_shift(self, trans):
+        """
+        Computes the phase shift translating images in fourier space: translating by t in real space multiplies the fourier transform by exp(-2i*pi*k.t)
+        :param trans: torch.tensor(B, T, 2) of translations in pixels, in YX mode.
+        :return: torch.tensor(B, T, N_pix, N_pix) complex phase shifts, in the centered order of primal_to_fourier2d.
+        """
+        phase_y = torch.exp(-2j*torch.pi*trans[..., 0, None]*self.freqs)
+        phase_x = torch.exp(-2j*torch.pi*trans[..., 1, None]*self.freqs)
+        return phase_y[..., :, None]*phase_x[..., None, :]
+
+    def transform_low_pass(self, images, trans, lp_mask2d):
+        """
+        Translates and low pass filters the images. In fourier mode, both are performed in a single fourier transform round trip.
+        :param images: torch.tensor(B, N_pix, N_pix) of images
+        :param trans: torch.tensor(B, 2) of translations in pixels, in YX mode.
+        :param lp_mask2d: torch.tensor(N_pix, N_pix) low pass filter in fourier space.
+        :return: torch.tensor(B, N_pix, N_pix) of translated and low pass filtered images.
+        """
+        if self.mode == "real":
+            return low_pass_images(self.transform(images, trans[:, None, :]), lp_mask2d)
+
+        return fourier2d_to_primal(self.fourier_transform_low_pass(images, trans, lp_mask2d))
+
+    def fourier_transform_low_pass(self, images, trans, lp_mask2d):
+        """
+        Translates and low pass filters the images, see transform_low_pass, and returns their fourier transforms. In fourier mode, no inverse fourier transform is performed.
+        :param images: torch.tensor(B, N_pix, N_pix) of images
+        :param trans: torch.tensor(B, 2) of translations in pixels, in YX mode.
+        :param lp_mask2d: torch.tensor(N_pix, N_pix) low pass filter in fourier space.
+        :return: torch.tensor(B, N_pix, N_pix) complex fourier transforms of the translated and low pass filtered images, in the centered order of primal_to_fourier2d.
+        """
+        if self.mode == "real":
+            return primal_to_fourier2d(self.transform(images, trans[:, None, :]))*lp_mask2d
+
+        assert self.D == images.shape[-1] == images.shape[-2]
+        return primal_to_fourier2d(images)*(self.phase_shift(trans[:, None, :])[:, 0]*lp_mask2d)
+
+
+class ImagePreprocessor(torch.nn.Module):
+    """
+    Preprocesses batches of raw images on the gpu: downsampling, masking and normalization, as done by the dataset on the cpu, followed by the
+    translation and low pass filtering of the training loop.
+    """
+    def __init__(self, side_shape, down_side_shape, f_std, image_translator, lp_mask2d, rad_mask=None, device=None, fourier=False):
+        """
+        :param side_shape: integer, number of pixels on each side of the raw images.
+        :param down_side_shape: integer, number of pixels on each side of the downsampled images.
+        :param f_std: float, standard deviation of the fourier coefficients of the images, see ImageDataSet.estimate_normalization.
+        :param image_translator: SpatialGridTranslate object used to translate the images according to the poses.
+        :param lp_mask2d: torch.tensor(down_side_shape, down_side_shape) low pass filter in fourier space.
+        :param rad_mask: float, radius of the mask applied to the images. If None, no mask is used.
+        :param device: torch device on which we perform the computations.
+        :param fourier: bool, if True the translated and low pass filtered images are returned as their fourier transforms.
+        """
+        super().__init__()
+        self.fourier = fourier
+        self.side_shape = side_shape
+        self.down_side_shape = down_side_shape
+        self.f_std = f_std
+        self.image_translator = image_translator
+        self.register_buffer("lp_mask2d", lp_mask2d)
+        self.input_mask = Mask(down_side_shape, rad_mask, device)
+
+    def forward(self, images, translations):
+        """
+        :param images: torch.tensor(batch_size, side_shape, side_shape) of raw images, in any floating point precision.
+        :param translations: torch.tensor(batch_size, 2) of translations of the images, in pixels of the downsampled images.
+        :return: torch.tensor(batch_size, down_side_shape, down_side_shape) of normalized images, the input of the encoder, and 
+                torch.tensor(batch_size, down_side_shape, down_side_shape) of the same images translated and low pass filtered, in fourier space if fourier is True.
+        """
+        images = images.float()
+        if self.down_side_shape != self.side_shape:
+            #Same interpolation as the resizing of torchvision used by the dataset.
+            images = F.interpolate(images[:, None], size=(self.down_side_shape, self.down_side_shape), mode="bilinear", antialias=True, 
+                                   align_corners=False)[:, 0]
+
+        images = self.input_mask(images)
+        #The mean of the fourier coefficients is set to 0 in the dataset, so normalizing in fourier space is just a division.
+        images = images / self.f_std
+        if self.fourier:
+            return images, self.image_translator.fourier_transform_low_pass(images, translations, self.lp_mask2d)
+
+        return images, self.image_translator.transform_low_pass(images, translations, self.lp_mask2d)
+
+
+PRECISIONS = {"fp32":torch.float32, "bf16":torch.bfloat16, "fp16":torch.float16}
+
+
+def reset_peak_memory(device):
+    """
+    Resets the peak memory statistics of a gpu, so that peak_memory reports the peak since this call. Does nothing on cpu.
+    :param device: torch device.
+    """
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+    """
+    Peak memory used by the tensors on a gpu since the last call to reset_peak_memory, or peak resident memory of the process on cpu.
+    On cpu, the peak is the high-water mark of the whole lifetime of the process, which reset_peak_memory cannot reset, and it includes
+    everything the process holds, not only the tensors. It is not comparable with the gpu peak.
+    :param device: torch device.
+    :return: float, memory in MB.
+    """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def log_step_statistics(epoch, N_steps, duration, precision, device, data_wait=None):
+    """
+    Logs the mean duration of a training step and the peak memory of an epoch on gpu, to compare the precisions and the settings. On cpu, the
+    peak resident memory of the process since its start is logged instead, see peak_memory.
+    :param epoch: integer, epoch number.
+    :param N_steps: integer, number of steps performed during the epoch.
+    :param duration: float, duration of the steps of the epoch in seconds.
+    :param precision: str, precision used for training.
+    :param device: torch device on which we train.
+    :param data_wait: float, time in seconds spent waiting for the data loader during the epoch, see dataset.DevicePrefetcher. Not logged if None.
+    """
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+        memory_string = f"peak memory of the epoch {peak_memory(device):.1f} MB"
+    else:
+        memory_string = f"peak resident memory since the start of the process {peak_memory(device):.1f} MB"
+
+    information_string = f"Epoch {epoch}, precision {precision}: mean step time {duration / N_steps:.4f}s over {N_steps} steps, {memory_string}."
+    if data_wait is not None:
+        #A large share of the step time spent waiting for the data means that reading and preprocessing the images is the bottleneck.
+        information_string += f" Mean data wait {data_wait / N_steps:.4f}s per step, {100 * data_wait / duration:.1f}% of the step time."
+
+    logging.info(information_string)
+
+
+def checkpoint_segment(function, *args, enabled=False):
+    """
+    Calls a function. If enabled, the intermediate tensors of the function are not stored for the backward pass but recomputed during it,
+    which lowers the activation memory at the cost of a second forward pass of the function.
+    :param function: function to call, it must not draw random numbers.
+    :param args: arguments of the function.
+    :param enabled: boolean, whether to checkpoint the function.
+    :return: the outputs of the function.
+    """
+    if not enabled:
+        return function(*args)
+
+    return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+
+
+def all_reduce_gradients(parameters):
+    """
+    Averages the gradients of the parameters over all the processes, in a single collective call. Does nothing if the training is not distributed.
+    :param parameters: iterable of torch.nn.Parameter. In distributed training, every process must pass the same parameters.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()) or torch.distributed.get_world_size() == 1:
+        return
+
+    parameters = [parameter for parameter in parameters if parameter.requires_grad]
+    #A parameter without gradient on this process may have one on another, so a zero gradient is used to keep the buffers of all the processes aligned.
+    for parameter in parameters:
+        if parameter.grad is None:
+            parameter.grad = torch.zeros_like(parameter)
+
+    grads = [parameter.grad for parameter in parameters]
+    flat_grads = torch._utils._flatten_dense_tensors(grads)
+    torch.distributed.all_reduce(flat_grads)
+    flat_grads /= torch.distributed.get_world_size()
+    for grad, reduced_grad in zip(grads, torch._utils._unflatten_dense_tensors(flat_grads, grads)):
+        grad.copy_(reduced_grad)
+
+
+class MetricsAccumulator:
+    """
+    Accumulates the training metrics on the device as running sums weighted by the number of images, so that tracking them does not
+    synchronize the device with the host at every step. The means are computed across all the processes only when reduce is called.
+    """
+    def __init__(self, names, device):
+        """
+        :param names: list of str, names of the metrics.
+        :param device: torch device on which the metrics are computed.
+        """
+        self.names = list(names)
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        """
+        Sets the running sums and the total weight to zero.
+        """
+        self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=self.device)
+        self.weight = 0.
+
+    def update(self, metrics, weight=1.):
+        """
+        Adds the values of the metrics to the running sums, without synchronizing the device with the host.
+        :param metrics: dictionnary of torch.tensor(1) values of the metrics, keyed by their names.
+        :param weight: float, weight of the values, typically the number of images they are computed on.
+        """
+        values = torch.stack([metrics[name].detach().to(torch.float64).reshape(()) for name in self.names])
+        self.sums += weight*values
+        self.weight += weight
+
+    def reduce(self):
+        """
+        Computes the weighted means of the metrics over all the updates of all the processes. This is a collective call: in distributed
+        training, every process must call it.
+        :return: dictionnary of floats, mean of each metric.
+        """
+        totals = torch.cat([self.sums, torch.tensor([self.weight], dtype=torch.float64, device=self.device)])
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(totals)
+
+        #This is the only synchronization of the device with the host.
+        totals = totals.cpu().numpy()
+        if totals[-1] == 0:
+            return {name: np.nan for name in self.names}
+
+        return {name: total/totals[-1] for name, total in zip(self.names, totals[:-1])}
+
 
 def monitor_training(segmentation, segmenter, tracking_metrics, experiment_settings, vae, optimizer, pred_im, true_im, gpu_id):
     """
     Monitors the training process through wandb and saving models. The metrics are logged into a file and optionnally sent to Weight and Biases.
     :param segmentation: torch.tensor(N_batch, N_residues, N_segments) weights of the segmentation
     :param segmenter: object of class Segmentation.
-    :param tracking_metrics: dictionnary containing metrics to plot.
+    :param tracking_metrics: dictionnary containing metrics to plot, the metrics being accumulated by a MetricsAccumulator under the key "metrics".
     :param experiment_settings: dictionnary containing parameters of the current experiment
     :param vae: object of class VAE.
     :param optimizer: optimizer object used in this run
     :param pred_im: torch.tensor(N_batch, N_pix, N_pix), sample of predicted images, without CTF corruption
     :param true_im: torch.tensor(N_batch, N_pix, N_pix), corresponding sample of true images. 
     """
+    #The means are reduced across all the processes, so every process must compute them.
+    metrics = tracking_metrics["metrics"].reduce()
     if gpu_id == 0:
         if tracking_metrics["wandb"] == True:
-            ignore = ["wandb", "epoch", "path_results", "betas"]
-            wandb.log({key: np.mean(val) for key, val in tracking_metrics.items() if key not in ignore})
+            wandb.log(metrics)
             wandb.log({"epoch": tracking_metrics["epoch"]})
             wandb.log({"lr_segmentation":optimizer.param_groups[0]['lr']})
             wandb.log({"lr":optimizer.param_groups[1]['lr']})
@@ -433,9 +698,9 @@ def monitor_training(segmentation, segmenter, tracking_metrics, experiment_setti
         segmenter_path = os.path.join(experiment_settings["folder_path"], "cryoSPHERE", "seg" + str(tracking_metrics["epoch"]) + ".pt" )
         torch.save(vae.state_dict(), model_path)
         torch.save(segmenter.state_dict(), segmenter_path)
-        information_strings = [f"""Epoch: {tracking_metrics["epoch"]} || Correlation loss: {tracking_metrics["correlation_loss"][0]} || KL prior latent: {tracking_metrics["kl_prior_latent"][0]} 
-            || KL prior segmentation std: {tracking_metrics["kl_prior_segmentation_std"][0]} || KL prior segmentation proportions: {tracking_metrics["kl_prior_segmentation_proportions"][0]} ||
-            l2 penalty: {tracking_metrics["l2_pen"][0]} || Continuity loss: {tracking_metrics["continuity_loss"][0]} || Clashing loss: {tracking_metrics["clashing_loss"][0]}"""]
+        information_strings = [f"""Epoch: {tracking_metrics["epoch"]} || Correlation loss: {metrics["correlation_loss"]} || KL prior latent: {metrics["kl_prior_latent"]} 
+            || KL prior segmentation std: {metrics["kl_prior_segmentation_std"]} || KL prior segmentation proportions: {metrics["kl_prior_segmentation_proportions"]} ||
+            l2 penalty: {metrics["l2_pen"]} || Continuity loss: {metrics["continuity_loss"]} || Clashing loss: {metrics["clashing_loss"]}"""]
         information_strings += [f"{loss_term} beta: {beta}" for loss_term, beta in tracking_metrics["betas"].items()]
         information_string = " || ".join(information_strings)
         logging.info(information_string)
@@ -497,15 +762,21 @@ def rotate_residues_einops(atom_positions, quaternions, segmentation, device):
     segmentation_rotation_per_segments_axis_angle = segmentation[:, :, :, None] * rotation_per_segments_axis_angle[:, None, :, :]
     #The below tensor is [N_batch, N_residues, N_segments, 4] with the real part as the last element from now on !!!!!
     segmentation_rotation_per_segments_quaternions = rotvec_to_unitquat(segmentation_rotation_per_segments_axis_angle)
-    #T = Transform3d(dtype=torch.float32, device = device)
-    transform = roma.RotationUnitQuat(segmentation_rotation_per_segments_quaternions[:, :, 0, :])
+    #The rotations of the segments are applied one after the other, from the first segment to the last one. Since the quaternion product
+    #is associative, we compose them with a tree reduction: at each level, the rotation of each pair of neighbouring segments is composed
+    #in a single product, the first segment of the pair being applied first.
+    quaternions_per_residue = segmentation_rotation_per_segments_quaternions
+    while quaternions_per_residue.shape[2] > 1:
+        if quaternions_per_residue.shape[2] % 2 == 1:
+            #Padding with the identity, applied last, does not change the composition.
+            identity = torch.zeros_like(quaternions_per_residue[:, :, :1, :])
+            identity[..., 3] = 1
+            quaternions_per_residue = torch.cat([quaternions_per_residue, identity], dim=2)
+
+        quaternions_per_residue = roma.quat_product(quaternions_per_residue[:, :, 1::2, :], quaternions_per_residue[:, :, 0::2, :])
+
+    transform = roma.RotationUnitQuat(quaternions_per_residue[:, :, 0, :])
     atom_positions = transform.apply(atom_positions[None, :, :])
-    #atom_positions = quaternion_apply(segmentation_rotation_per_segments_quaternions[:, :, 0, :], atom_positions)
-    for segm in range(1, N_segments):
-        transform = roma.RotationUnitQuat(segmentation_rotation_per_segments_quaternions[:, :, segm, :])
-        atom_positions = transform.apply(atom_positions)
-        #atom_positions = quaternion_apply(segmentation_rotation_per_segments_quaternions[:, :, segm, :], atom_positions)
-
     return atom_positions
 
 def compute_translations_per_residue(translation_vectors, segmentations, N_residues, batch_size, device):
@@ -513,16 +784,16 @@ def compute_translations_per_residue(translation_vectors, segmentations, N_resid
     Computes one translation vector per residue based on the segmentation
     :param translation_vectors: dictionnary, for each part of the protein torch.tensor (Batch_size, N_segments, 3) translations for each domain 
     :param segmentations: dictionnary of torch.tensor(N_batch, N_residues, N_segments) representing the weights of the segmentation
-                         and mask to find the relevant residues among the protein.
+                         and indexes of the relevant residues among the protein, see Segmentation.sample_segmentation.
     :param N_residues: integer, total number of residues in the protein
     :param batch_size: integer, size of the batch.
     :param device: torch device on which we perform the computations.
     :return: translation per residue torch.tensor(batch_size, N_residues, 3)
     """
+    indexes = torch.cat([segm["indexes"] for segm in segmentations.values()])
+    translations = torch.cat([torch.einsum("bij, bjk -> bik", segm["segmentation"], translation_vectors[part]) for part, segm in segmentations.items()], dim=1)
     translation_per_residue = torch.zeros((batch_size, N_residues, 3), dtype=torch.float32, device=device)
-    for part, segm in segmentations.items():
-        translation_per_residue[:, segm["mask"] == 1] += torch.einsum("bij, bjk -> bik", segm["segmentation"], translation_vectors[part])
-
+    translation_per_residue = translation_per_residue.index_add(1, indexes, translations)
     return translation_per_residue
 
 def deform_structure(atom_positions, translation_per_residue, quaternions, segmentations, device):
@@ -532,15 +803,16 @@ def deform_structure(atom_positions, translation_per_residue, quaternions, segme
     :param translation_per_residue: tensor (Batch_size, N_residues, 3)
     :param quaternions: tensor (N_batch, N_segments, 4) of quaternions for the rotation of the segments
     :param segmentations: dictionnary of torch.tensor(N_batch, N_residues, N_segments) representing the weights of the segmentation 
-                          and mask to find the relevant residues among the protein.
+                          and indexes of the relevant residues among the protein, see Segmentation.sample_segmentation.
     :param device: torch device on which the computation takes place
     :return: tensor (Batch_size, N_residues, 3) corresponding to translated structure
     """
     batch_size = translation_per_residue.shape[0]
-    transformed_atom_positions = atom_positions[None, :, :].repeat((batch_size, 1, 1))
-    for part, segm in segmentations.items():
-        transformed_atom_positions[:, segm["mask"]==1]  = rotate_residues_einops(atom_positions[segm["mask"]==1] , quaternions[part], segm["segmentation"], device)
-
+    indexes = torch.cat([segm["indexes"] for segm in segmentations.values()])
+    rotated_atom_positions = torch.cat([rotate_residues_einops(atom_positions[segm["indexes"]], quaternions[part], segm["segmentation"], device) 
+                                        for part, segm in segmentations.items()], dim=1)
+    #The residues that do not belong to any part are left untouched.
+    transformed_atom_positions = atom_positions[None, :, :].expand(batch_size, -1, -1).index_copy(1, indexes, rotated_atom_positions)
     new_atom_positions = transformed_atom_positions + translation_per_residue
     return new_atom_positions
 
@@ -0,0 +1,35 @@
+import sys
+import torch
+import unittest
+import numpy as np
+sys.path.insert(1, '../model')
+from ctf import CTF
+
+
+class TestCtfCache(unittest.TestCase):
+	"""
+	Class for testing that the cached ctf matches the ctf computed for each particle.
+	"""
+	def setUp(self):
+		rng = np.random.default_rng(0)
+		N_particles = 60
+		#Groups of particles share the same parameters, as the particles of a micrograph do.
+		groups = rng.integers(0, 12, N_particles)
+		defocusU = rng.uniform(10000, 20000, 12)[groups]
+		defocusV = defocusU - rng.uniform(0, 500, 12)[groups]
+		defocusAngle = rng.uniform(0, 180, 12)[groups]
+		ones = np.ones(N_particles)
+		ctf_parameters = (32*ones, 1.5*ones, defocusU, defocusV, defocusAngle, 300*ones, 2.7*ones, 0.1*ones)
+		self.ctf = CTF(*ctf_parameters)
+		#The cache is smaller than the number of groups, so that the least recently used ctf are evicted.
+		self.ctf_cached = CTF(*ctf_parameters, cache_size=5)
+		self.batches = [torch.from_numpy(rng.choice(N_particles, 16, replace=False)) for _ in range(10)]
+
+	def test_cached_ctf(self):
+		for half in [False, True]:
+			for indexes in self.batches:
+				ctf = self.ctf.compute_ctf_uncached(indexes, half)
+				ctf_cached = self.ctf_cached.compute_ctf_cached(indexes, half)
+				self.assertEqual(ctf.shape, ctf_cached.shape)
+				self.assertAlmostEqual(torch.max(torch.abs(ctf - ctf_cached)).item(), 0.0, 6)
+				self.assertLessEqual(len(self.ctf_cached.cache), 5)
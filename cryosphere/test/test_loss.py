@@ -0,0 +1,111 @@
+import sys
+import torch
+import unittest
+import numpy as np
+from scipy.spatial import distance
+sys.path.insert(1, '../model')
+from fourier import primal_to_fourier2d
+from loss import calc_cor_loss, calc_cor_loss_fourier, calc_std_fourier, find_range_cutoff_pairs, remove_duplicate_pairs, ClashNeighborList
+
+def find_range_cutoff_pairs_old(coord_arr, min_cutoff=4., max_cutoff=10.):
+	"""
+	Brute force version of find_range_cutoff_pairs, using the dense distance map.
+	"""
+	dist_map = distance.cdist(coord_arr, coord_arr, metric='euclidean')
+	sel_mask = (dist_map <= max_cutoff) & (dist_map >= min_cutoff)
+	indices_in_pdb = np.nonzero(sel_mask)
+	return np.column_stack((indices_in_pdb[0], indices_in_pdb[1]))
+
+def remove_duplicate_pairs_old(pairs_a, pairs_b, remove_flip=True):
+	"""
+	Dense mask version of remove_duplicate_pairs.
+	"""
+	s = max(pairs_a.max(), pairs_b.max()) + 1
+	mask = np.zeros((s, s), dtype=bool)
+	np.put(mask, np.ravel_multi_index(pairs_a.T, mask.shape), True)
+	np.put(mask, np.ravel_multi_index(pairs_b.T, mask.shape), False)
+	if remove_flip:
+		np.put(mask, np.ravel_multi_index(np.flip(pairs_b, 1).T, mask.shape), False)
+
+	return np.column_stack(np.nonzero(mask))
+
+
+class TestFourierCorrelationLoss(unittest.TestCase):
+	"""
+	Class for testing that the correlation loss computed in fourier space with Parseval's theorem matches the one computed in real space.
+	"""
+	def setUp(self):
+		torch.manual_seed(0)
+		self.images = {N_pix: torch.randn((8, N_pix, N_pix), dtype=torch.float64) + 0.3 for N_pix in [32, 33]}
+		self.gt_images = {N_pix: 0.5*images + torch.randn_like(images) for N_pix, images in self.images.items()}
+
+	def test_std_fourier(self):
+		for N_pix, images in self.images.items():
+			std = torch.std(images.flatten(start_dim=-2), dim=-1)
+			std_fourier = calc_std_fourier(primal_to_fourier2d(images))
+			self.assertAlmostEqual(torch.max(torch.abs(std - std_fourier)).item(), 0.0, 8)
+
+	def test_cor_loss_fourier(self):
+		for N_pix, images in self.images.items():
+			loss = calc_cor_loss(images, self.gt_images[N_pix])
+			loss_fourier = calc_cor_loss_fourier(primal_to_fourier2d(images), primal_to_fourier2d(self.gt_images[N_pix]))
+			self.assertAlmostEqual(loss.item(), loss_fourier.item(), 8)
+
+
+class TestClashingPairs(unittest.TestCase):
+	"""
+	Class for testing that the pairs found with a KD-tree and the sorted set difference match the brute force versions.
+	"""
+	def setUp(self):
+		rng = np.random.default_rng(0)
+		steps = rng.normal(size=(500, 3))
+		self.coord_arr = np.cumsum(3.8*steps/np.linalg.norm(steps, axis=-1, keepdims=True), axis=0)
+
+	def test_range_cutoff_pairs(self):
+		for min_cutoff, max_cutoff in [(4., 10.), (0., 10.), (0., 4.), (2., 6.)]:
+			pairs = find_range_cutoff_pairs(self.coord_arr, min_cutoff, max_cutoff)
+			pairs_old = find_range_cutoff_pairs_old(self.coord_arr, min_cutoff, max_cutoff)
+			self.assertEqual(pairs.shape, pairs_old.shape)
+			self.assertTrue(np.array_equal(pairs, pairs_old))
+
+	def test_remove_duplicate_pairs(self):
+		pairs_a = find_range_cutoff_pairs(self.coord_arr, 0., 10.)
+		#Consecutive residues, as the continuity loss uses, given in a single order.
+		pairs_b = np.column_stack((np.arange(499), np.arange(1, 500)))
+		for remove_flip in [True, False]:
+			pairs = remove_duplicate_pairs(pairs_a, pairs_b, remove_flip)
+			pairs_old = remove_duplicate_pairs_old(pairs_a, pairs_b, remove_flip)
+			self.assertTrue(np.array_equal(pairs, pairs_old))
+
+
+class TestClashNeighborList(unittest.TestCase):
+	"""
+	Class for testing that the neighbor list finds all the clashing pairs and is reused for shuffled batches of similar structures.
+	"""
+	def setUp(self):
+		torch.manual_seed(0)
+		steps = torch.randn((300, 3), dtype=torch.float64)
+		base_structure = torch.cumsum(3.8*steps/torch.linalg.vector_norm(steps, dim=-1, keepdim=True), dim=0)
+		self.structures = base_structure[None] + 0.3*torch.randn((16, 300, 3), dtype=torch.float64)
+
+	def dense_clashing_pairs(self, structures, cutoff):
+		distances = torch.cdist(structures, structures)
+		close = torch.any(distances < cutoff, dim=0)
+		return {(i, j) for i, j in torch.nonzero(torch.triu(close, diagonal=2)).tolist()}
+
+	def test_clashing_pairs(self):
+		neighbor_list = ClashNeighborList(cutoff=4.0, skin=2.0, rebuild_every=100)
+		pairs = neighbor_list.update(self.structures)
+		pairs = {(i, j) for i, j in pairs.tolist()}
+		self.assertTrue(self.dense_clashing_pairs(self.structures, 4.0).issubset(pairs))
+		self.assertEqual(self.dense_clashing_pairs(self.structures, 6.0), pairs)
+
+	def test_shuffled_batches(self):
+		neighbor_list = ClashNeighborList(cutoff=4.0, skin=2.0, rebuild_every=100)
+		neighbor_list.update(self.structures)
+		#The same particles in another order, slightly moved, reuse the list.
+		shuffled_structures = self.structures[torch.randperm(16)] + 0.05*torch.randn_like(self.structures)
+		self.assertFalse(neighbor_list.needs_rebuild(shuffled_structures[:8]))
+		#A residue moved by more than skin/2 from all the reference structures forces a rebuild.
+		shuffled_structures[3, 10] += 1.5
+		self.assertTrue(neighbor_list.needs_rebuild(shuffled_structures))
@@ -0,0 +1,68 @@
+import sys
+import torch
+import unittest
+import numpy as np
+sys.path.insert(1, '../model')
+from gmm import EMAN2Grid
+from renderer import project, project_fourier
+from fourier import primal_to_fourier2d
+
+
+class TestChunkedProjection(unittest.TestCase):
+	"""
+	Class for testing that the chunked projection, with its hand written backward pass, matches the dense projection.
+	"""
+	def setUp(self):
+		torch.manual_seed(0)
+		self.batch_size = 4
+		self.N_atoms = 50
+		self.grid = EMAN2Grid(32, 1.0).double()
+		self.Gauss_mean = (torch.randn((self.batch_size, self.N_atoms, 3), dtype=torch.float64)*5).requires_grad_(True)
+		self.Gauss_sigmas = (torch.rand((self.N_atoms, 1), dtype=torch.float64) + 1.5).requires_grad_(True)
+		self.Gauss_amplitudes = (torch.rand((self.N_atoms, 1), dtype=torch.float64) + 0.5).requires_grad_(True)
+		self.grad_images = torch.randn((self.batch_size, 32, 32), dtype=torch.float64)
+
+	def test_chunked_projection(self):
+		"""
+		Tests the images and the gradients with respect to the means, the sigmas and the amplitudes, for chunk sizes that do and do not divide
+		the number of atoms.
+		"""
+		inputs = [self.Gauss_mean, self.Gauss_sigmas, self.Gauss_amplitudes]
+		images = project(*inputs, self.grid)
+		grads = torch.autograd.grad(images, inputs, self.grad_images)
+		for chunk_size in [1, 7, 10, 50, 64]:
+			chunked_images = project(*inputs, self.grid, chunk_size=chunk_size)
+			chunked_grads = torch.autograd.grad(chunked_images, inputs, self.grad_images)
+			self.assertAlmostEqual(torch.max(torch.abs(images - chunked_images)).item(), 0.0, 8)
+			for grad, chunked_grad in zip(grads, chunked_grads):
+				self.assertAlmostEqual(torch.max(torch.abs(grad - chunked_grad)).item(), 0.0, 8)
+
+	def test_chunked_projection_gradcheck(self):
+		"""
+		Checks the hand written backward pass against finite differences.
+		"""
+		inputs = (self.Gauss_mean[:1, :9].detach().requires_grad_(True), self.Gauss_sigmas[:9].detach().requires_grad_(True),
+				  self.Gauss_amplitudes[:9].detach().requires_grad_(True))
+		self.assertTrue(torch.autograd.gradcheck(lambda mean, sigmas, amplitudes: project(mean, sigmas, amplitudes, self.grid, chunk_size=4), inputs))
+
+
+class TestFourierRendering(unittest.TestCase):
+	"""
+	Class for testing that the closed form fourier rendering matches the fourier transform of the real space projection.
+	"""
+	def test_project_fourier(self):
+		"""
+		The Gaussians are kept wider than a pixel and away from the edges, so that the aliasing neglected by project_fourier is negligible.
+		Both even and odd numbers of pixels are tested, since the center of the images differs.
+		"""
+		torch.manual_seed(0)
+		for N_pix in [32, 33]:
+			for apix in [1.0, 1.5]:
+				grid = EMAN2Grid(N_pix, apix).double()
+				Gauss_mean = torch.randn((3, 40, 3), dtype=torch.float64)*N_pix*apix/10
+				Gauss_sigmas = torch.ones((40, 1), dtype=torch.float64)*2
+				Gauss_amplitudes = torch.rand((40, 1), dtype=torch.float64) + 0.5
+				fourier_images = primal_to_fourier2d(project(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid))
+				fourier_images_closed_form = project_fourier(Gauss_mean, Gauss_sigmas, Gauss_amplitudes, grid)
+				relative_error = torch.max(torch.abs(fourier_images - fourier_images_closed_form))/torch.max(torch.abs(fourier_images))
+				self.assertLess(relative_error.item(), 1e-3)
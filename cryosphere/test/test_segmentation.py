@@ -7,6 +7,7 @@ import numpy as np
 sys.path.insert(1, '../model')
 from segmentation import Segmentation
 from utils import compute_translations_per_residue, deform_structure, parse_yaml
+from utils import rotate_residues_einops as rotate_residues_tree
 from pytorch3d.transforms import quaternion_to_axis_angle, axis_angle_to_quaternion, quaternion_apply
 
 def rotate_residues_einops(atom_positions, quaternions, segmentation, device):
@@ -232,6 +233,21 @@ class TestMovingResidues(unittest.TestCase):
 		diff = np.max(torch.abs(new_atom_positions - new_atom_positions_old).detach().cpu().numpy())
 		self.assertAlmostEqual(diff, 0.0, 5)
 
+	def test_tree_sequential_rotations(self):
+		"""
+		Tests that composing the rotations of the segments with a tree reduction gives the same structures as applying them one after the
+		other, including odd numbers of segments, for which the tree reduction pads with the identity.
+		"""
+		for N_segments in [1, 2, 5, 7, 8]:
+			segmentation_config = {"part1":{"N_segm":N_segments, "all_protein":True}}
+			segmenter = Segmentation(segmentation_config, self.residues_indexes, self.residues_chain, tau_segmentation=0.05)
+			segmentation = segmenter.sample_segments(self.batch_size)["part1"]["segmentation"].detach()
+			quaternions = pytorch3d.transforms.random_quaternions(N_segments*self.batch_size, device=self.device).reshape(self.batch_size, N_segments, -1)
+			new_atom_positions = rotate_residues_tree(self.atom_positions, quaternions, segmentation, self.device)
+			new_atom_positions_sequential = rotate_residues_einops(self.atom_positions, quaternions, segmentation, self.device)
+			diff = np.max(torch.abs(new_atom_positions - new_atom_positions_sequential).detach().cpu().numpy())
+			self.assertAlmostEqual(diff, 0.0, 4)
+
 
 	#def test_yaml_parsing(self):
 	#	"""